@@ -0,0 +1,20 @@
+from random import Random
+from typing import List
+
+# fragments join into a valid SMILES string in any order
+FRAGMENTS = ["C", "CC", "CCC", "N", "O", "C(=O)O", "C(=O)N", "C(C)C",
+             "C(Cl)", "C(F)(F)", "c1ccccc1", "c1ccncc1", "C1CCCCC1",
+             "C1CCOC1", "c1ccc(O)cc1", "S", "C=C", "C#C", "C(=O)"]
+
+
+def synthetic_smiles(n: int, seed: int = 42,
+                     min_fragments: int = 2,
+                     max_fragments: int = 8) -> List[str]:
+    """
+    Build a reproducible library of *`n`* SMILES strings joining
+    random fragments, the same *`seed`* gives the same library.
+    """
+    random = Random(seed)
+    return ["".join(random.choices(
+        FRAGMENTS, k=random.randint(min_fragments, max_fragments)))
+        for _ in range(n)]
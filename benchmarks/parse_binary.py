@@ -0,0 +1,36 @@
+"""
+Compare parsing molecules from SMILES strings with loading them
+from `Mol.ToBinary()` pickles stored in the database.
+
+    python -m benchmarks.parse_binary [number of molecules]
+"""
+import sys
+from time import perf_counter
+from rdkit.Chem import Mol, MolFromSmiles
+from benchmarks.library import synthetic_smiles
+
+
+def main(n: int = 100_000) -> None:
+    smiles = synthetic_smiles(n)
+    binaries = [MolFromSmiles(s).ToBinary() for s in smiles]
+
+    start = perf_counter()
+    for s in smiles:
+        MolFromSmiles(s)
+    parse_time = perf_counter() - start
+
+    start = perf_counter()
+    for binary in binaries:
+        Mol(binary)
+    load_time = perf_counter() - start
+
+    print(f"{n} molecules")
+    print(f"MolFromSmiles: {parse_time:.2f} s, "
+          f"{n / parse_time:,.0f} molecules/s")
+    print(f"Mol(binary):   {load_time:.2f} s, "
+          f"{n / load_time:,.0f} molecules/s")
+    print(f"speedup: {parse_time / load_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:2]))
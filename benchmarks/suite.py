@@ -0,0 +1,259 @@
+"""
+Measure the substructure search, the bulk import, the search cache
+and the API latency on synthetic libraries, offline with SQLite and
+fakeredis in place of PostgreSQL and Redis.
+
+    python -m benchmarks.suite [sizes] [--output results.json]
+        [--baseline baseline.json] [--tolerance 0.25]
+
+Every library size, 1k, 100k and 1M molecules by default, runs in its
+own process and temporary directory, so it starts with an empty
+database. Compared with the results of an earlier run as *baseline*,
+a throughput (`*_per_s`) lower or a latency (`*_ms`) higher by more
+than *tolerance* is a regression and the exit status is 1.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Dict, List
+import numpy as np
+from benchmarks.library import synthetic_smiles
+
+SIZES = (1_000, 100_000, 1_000_000)
+# substructures searched in every library, common and rare ones
+QUERIES = ["c1ccccc1", "C(=O)N", "c1ccncc1C(F)(F)"]
+# requests timed for every endpoint
+REQUESTS = 200
+# uncached searches timed for every query
+MISSES = 3
+
+
+def use_fakeredis() -> None:
+    """ Replace the Redis clients of the web process with fakeredis
+    sharing one server and run the Celery tasks in this process """
+    import fakeredis.aioredis
+    from src import caching, main, tasks
+    from src.celery_worker import celery
+
+    server = fakeredis.FakeServer()
+    clients = {
+        "redis_client": fakeredis.FakeRedis(server=server,
+                                            decode_responses=True),
+        "async_redis_client": fakeredis.aioredis.FakeRedis(
+            server=server, decode_responses=True),
+        "cache_client": fakeredis.FakeRedis(server=server),
+        "async_cache_client": fakeredis.aioredis.FakeRedis(server=server),
+    }
+    for module in (caching, main, tasks):
+        for name, client in clients.items():
+            if hasattr(module, name):
+                setattr(module, name, client)
+    celery.conf.task_always_eager = True
+
+
+def latency(request: Callable, repeats: int) -> Dict[str, float]:
+    """ Time *`request`* made *`repeats`* times """
+    samples = []
+    for _ in range(repeats):
+        start = perf_counter()
+        response = request()
+        samples.append((perf_counter() - start) * 1000)
+        response.raise_for_status()
+    p50, p99 = np.percentile(samples, [50, 99])
+    return {"p50_ms": float(p50), "p99_ms": float(p99)}
+
+
+def run(n: int, seed: int = 42, requests: int = REQUESTS) -> dict:
+    """ Benchmark a library of *`n`* synthetic molecules stored
+    in the SQLite database of the current directory """
+    use_fakeredis()
+    from starlette.testclient import TestClient
+    from src.dao import MoleculeDAO, migrate
+    from src.importer import import_molecules
+    from src.library import SCAN_BATCH_SIZE, SEARCH_LIBRARY, library
+    from src.main import app
+    from src.store import update_store
+    from src.tasks import substructure_search
+
+    migrate()
+    results = {}
+    smiles = synthetic_smiles(n, seed)
+    start = perf_counter()
+    summary = asyncio.run(import_molecules(smiles))
+    results["import"] = {"molecules_per_s": n / (perf_counter() - start),
+                         **summary}
+    print(f"{n}: imported {summary}", file=sys.stderr)
+
+    rows = [row for batch in MoleculeDAO.scan(SCAN_BATCH_SIZE)
+            for row in batch]
+    _, mols, fingerprints, binaries = map(list, zip(*rows))
+    start = perf_counter()
+    hits = sum(len(list(substructure_search(mols, query, fingerprints,
+                                            True, binaries)))
+               for query in QUERIES)
+    results["substructure_search"] = {
+        "molecules_per_s": len(mols) * len(QUERIES) / (perf_counter() - start),
+        "hits": hits}
+    del rows, mols, fingerprints, binaries
+
+    if SEARCH_LIBRARY == "mmap":
+        update_store()
+    start = perf_counter()
+    library.load()
+    load_time = perf_counter() - start
+    start = perf_counter()
+    for query in QUERIES:
+        for _ in library.matches(query):
+            pass
+    results["library"] = {
+        "load_ms": load_time * 1000,
+        "molecules_per_s": len(library) * len(QUERIES)
+        / (perf_counter() - start)}
+    print(f"{n}: searched", file=sys.stderr)
+
+    client = TestClient(app)
+    random = Random(seed)
+    count = MoleculeDAO.count()
+    queries = iter(QUERIES * requests)
+    results["cache"] = {
+        "miss": latency(lambda: client.get(f"/search/{next(queries)}",
+                                           params={"no_cache": True}),
+                        MISSES * len(QUERIES)),
+        "hit": latency(lambda: client.get(f"/search/{next(queries)}"),
+                       requests)}
+    results["endpoints"] = {
+        "GET /smiles/{identifier}": latency(
+            lambda: client.get(f"/smiles/{random.randint(1, count)}"),
+            requests),
+        "GET /smiles/": latency(
+            lambda: client.get("/smiles/", params={
+                "offset": random.randrange(count)}), requests),
+        "GET /smiles/exact/": latency(
+            lambda: client.get("/smiles/exact/", params={
+                "smiles": smiles[random.randrange(n)]}), requests),
+        "GET /search/{mol}": latency(
+            lambda: client.get(f"/search/{random.choice(QUERIES)}",
+                               params={"offset": random.randrange(100)}),
+            requests),
+        "GET /similarity/{mol}": latency(
+            lambda: client.get(f"/similarity/{smiles[random.randrange(n)]}"),
+            requests)}
+    print(f"{n}: requested", file=sys.stderr)
+    return results
+
+
+def metrics(results: dict, prefix: str = "") -> Dict[str, float]:
+    """ Flatten the numbers of *`results`* into dotted names """
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(metrics(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)):
+            flat[prefix + name] = value
+    return flat
+
+
+def compare(results: dict, baseline: dict,
+            tolerance: float = 0.25) -> List[str]:
+    """ Get the throughputs and latencies of *`results`* worse than
+    in *`baseline`* by more than a *`tolerance`* fraction """
+    measured = metrics(results["sizes"])
+    regressions = []
+    for name, base in metrics(baseline["sizes"]).items():
+        if (value := measured.get(name)) is None or base <= 0:
+            continue
+        if name.endswith("_per_s"):
+            worse = 1 - value / base
+        elif name.endswith("_ms"):
+            worse = value / base - 1
+        else:
+            continue
+        if worse > tolerance:
+            regressions.append(f"{name}: {base:.4g} -> {value:.4g} "
+                               f"({worse:.0%} worse)")
+    return regressions
+
+
+def benchmark(sizes: List[int], seed: int = 42,
+              requests: int = REQUESTS) -> dict:
+    """ Run every library size in its own process and directory """
+    from rdkit import __version__ as rdkit_version
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    # the SQLite database is used without DB_HOST
+    env.pop("DB_HOST", None)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [root, env.get("PYTHONPATH")]))
+    results = {"meta": {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "rdkit": rdkit_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "seed": seed,
+        "requests": requests,
+        "search_library": env.get("SEARCH_LIBRARY", "memory"),
+        "search_workers": int(env.get("SEARCH_WORKERS", "0"))},
+        "sizes": {}}
+    for n in sizes:
+        with TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            subprocess.run([sys.executable, "-m", "benchmarks.suite",
+                            "--run", str(n), "--seed", str(seed),
+                            "--requests", str(requests),
+                            "--output", output],
+                           cwd=directory, env=env, check=True)
+            with open(output) as file:
+                results["sizes"][str(n)] = json.load(file)
+    return results
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the search, the import, the cache "
+                    "and the API on synthetic libraries")
+    parser.add_argument("sizes", nargs="?",
+                        default=",".join(map(str, SIZES)),
+                        help="comma separated numbers of molecules")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--requests", type=int, default=REQUESTS,
+                        help="requests timed for every endpoint")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline",
+                        help="JSON results of an earlier run to compare")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    # benchmark one size in this process, run by `benchmark`
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run is not None:
+        results = run(args.run, args.seed, args.requests)
+    else:
+        results = benchmark([int(n) for n in args.sizes.split(",")],
+                            args.seed, args.requests)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    if args.run is not None or not args.baseline:
+        return 0
+    with open(args.baseline) as file:
+        regressions = compare(results, json.load(file), args.tolerance)
+    for regression in regressions:
+        print(f"regression {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
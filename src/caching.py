@@ -1,19 +1,286 @@
 import redis
+import redis.asyncio
 import json
+import zlib
+from os import getenv
+from typing import Any, Dict, List, Tuple
+import msgpack
+from redis.exceptions import WatchError
+from src.chemistry import canonical_query
+from src.metrics import cache_lookup, stage
 
 # Connect to Redis
 redis_client = redis.Redis(host='redis', port=6379, db=0,
                            protocol=3, decode_responses=True)
 # url_connection = redis.from_url("redis://localhost:6379?decode_responses="
 #                                 "True&health_check_interval=2&protocol=3")
+# the same for the async web handlers, sharing the connections
+async_pool = redis.asyncio.ConnectionPool(host='redis', port=6379, db=0,
+                                          protocol=3, decode_responses=True)
+async_redis_client = redis.asyncio.Redis(connection_pool=async_pool)
+# the cached values are binary
+cache_client = redis.Redis(host='redis', port=6379, db=0, protocol=3)
+async_cache_pool = redis.asyncio.ConnectionPool(host='redis', port=6379,
+                                                db=0, protocol=3)
+async_cache_client = redis.asyncio.Redis(connection_pool=async_cache_pool)
 
+# seconds a cached result is kept, the keys of a search change
+# with every write so the expiration only frees unused results
+CACHE_TTL = int(getenv("CACHE_TTL", "86400"))
+# canonical SMILES or SMARTS of the cached search queries
+# and their last version
+CACHED_QUERIES = "search:queries"
+# seconds a search task is known as in flight at most
+SEARCH_TASK_TTL = int(getenv("SEARCH_TASK_TTL", "600"))
+# "msgpack" or "json" encoding of the cached values
+CACHE_SERIALIZER = getenv("CACHE_SERIALIZER", "msgpack")
+# encoded cached values of more bytes are compressed
+CACHE_COMPRESS_SIZE = int(getenv("CACHE_COMPRESS_SIZE", "1024"))
 
-def get_cached_result(key: str):
-    result = redis_client.get(key)
+
+class JSONSerializer:
+    """ Cached values as JSON text """
+    tag = b"j"
+
+    @staticmethod
+    def dumps(value: Any) -> bytes:
+        return json.dumps(value).encode()
+
+    @staticmethod
+    def loads(data: bytes) -> Any:
+        return json.loads(data)
+
+
+class MsgpackSerializer:
+    """ Cached values as MessagePack, the integers take 1 to 9 bytes """
+    tag = b"m"
+
+    @staticmethod
+    def dumps(value: Any) -> bytes:
+        return msgpack.packb(value)
+
+    @staticmethod
+    def loads(data: bytes) -> Any:
+        return msgpack.unpackb(data)
+
+
+serializers = {JSONSerializer.tag: JSONSerializer,
+               MsgpackSerializer.tag: MsgpackSerializer}
+serializer = {"json": JSONSerializer,
+              "msgpack": MsgpackSerializer}[CACHE_SERIALIZER]
+# the tag of compressed values before the tag of their serializer
+COMPRESSED = b"z"
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Encode a cached *`value`* with the `serializer`, compressed
+    with zlib if it is longer than `CACHE_COMPRESS_SIZE` bytes.
+
+    The encoded value starts with the tags of its encoding, so values
+    cached with another serializer are still read by `loads`.
+    """
+    with stage("serialization"):
+        data = serializer.dumps(value)
+        if len(data) > CACHE_COMPRESS_SIZE:
+            return COMPRESSED + serializer.tag + zlib.compress(data)
+        return serializer.tag + data
+
+
+def loads(data: bytes) -> Any:
+    """ Decode a cached value encoded by `dumps` """
+    with stage("deserialization"):
+        if data[:1] == COMPRESSED:
+            return serializers[data[1:2]].loads(zlib.decompress(data[2:]))
+        return serializers[data[:1]].loads(data[1:])
+
+
+def search_key(mol: str, version: int) -> str:
+    """
+    Cache key of the substructure search for *`mol`* as SMILES string,
+    or a SMARTS query, among the stored molecules at change number
+    *`version`*.
+
+    Equivalent SMILES strings of a query share the key by its
+    canonical SMILES, and every write to the stored molecules
+    moves the searches to new keys.
+    """
+    return f"search:{version}:{canonical_query(mol)}"
+
+
+def search_task_key(mol: str, version: int, time_budget: float = 0) -> str:
+    """
+    Key of the search task in flight for *`mol`* at *`version`*
+    stopping after *`time_budget`* seconds.
+
+    Only the same searches with the same budget share a task, complete
+    searches without a budget share the key of their cached result.
+    """
+    key = search_key(mol, version)
+    if time_budget > 0:
+        key += f":budget:{time_budget:g}"
+    return key
+
+
+def get_cached_result(key: str, counted: bool = True):
+    """
+    Get the value cached at *`key`*, or `None`.
+
+    The lookups of the service itself are not *`counted`*
+    in the cache hit ratio.
+    """
+    with stage("cache_get"):
+        result = cache_client.get(key)
+    if counted:
+        cache_lookup(bool(result))
     if result:
-        return json.loads(result)
+        return loads(result)
     return None
 
 
-def set_cache(key: str, value: dict, expiration: int = 60):
-    redis_client.setex(key, expiration, json.dumps(value))
+async def aget_cached_result(key: str):
+    """ `get_cached_result` awaited on the event loop """
+    with stage("cache_get"):
+        result = await async_cache_client.get(key)
+    cache_lookup(bool(result))
+    if result:
+        return loads(result)
+    return None
+
+
+async def aget_cached_results(keys: List[str]) -> List[dict | None]:
+    """ `aget_cached_result` of many *`keys`* in one request """
+    if not keys:
+        return []
+    with stage("cache_get"):
+        results = await async_cache_client.mget(keys)
+    for result in results:
+        cache_lookup(bool(result))
+    return [loads(result) if result else None for result in results]
+
+
+def set_cache(key: str, value: Any, expiration: int = CACHE_TTL):
+    """ Cache *`value`* at *`key`* for *`expiration`* seconds """
+    data = dumps(value)
+    with stage("cache_set"):
+        cache_client.setex(key, expiration, data)
+
+
+def cache_search(mol: str, version: int,
+                 hits: List[Tuple[int, str]]) -> dict:
+    """
+    Cache the complete search result of *`mol`* at change number
+    *`version`* as the molecule ids of its *`hits`*, and register
+    the query to keep its result up to date on writes.
+
+    The cached `ids` are turned into SMILES strings only when they
+    are sent, by `MoleculeDAO.hits`. Returns the search result
+    with the SMILES strings of *`hits`*.
+    """
+    cache_ids(mol, version, [id for id, _ in hits])
+    return {"query": mol, "result": [smiles for _, smiles in hits]}
+
+
+def cache_ids(mol: str, version: int, ids: List[int]) -> None:
+    """ `cache_search` of the hits with *`ids`* """
+    set_cache(search_key(mol, version), {"query": mol, "ids": ids})
+    redis_client.hset(CACHED_QUERIES, canonical_query(mol), version)
+
+
+def store_hits(key: str, ids: List[int],
+               expiration: int = CACHE_TTL) -> str:
+    """
+    Store the molecule *`ids`* found by a search task as a list at
+    `hits:`*`key`* for *`expiration`* seconds, so its result is only
+    the key and it is read a page at a time by `get_hits`.
+
+    Returns the key of the list.
+    """
+    hits_key = f"hits:{key}"
+    pipeline = redis_client.pipeline()
+    pipeline.delete(hits_key)
+    for start in range(0, len(ids), 10000):
+        pipeline.rpush(hits_key, *ids[start:start + 10000])
+    pipeline.expire(hits_key, expiration)
+    pipeline.execute()
+    return hits_key
+
+
+def get_hits(hits_key: str, offset: int = 0, limit: int = 100) -> List[int]:
+    """ Get the molecule ids stored by `store_hits` from *`offset`* """
+    if limit <= 0:
+        return []
+    return [int(id) for id in redis_client.lrange(hits_key, offset,
+                                                  offset + limit - 1)]
+
+
+def forget_cached_query(query: str, version: int) -> bool:
+    """
+    Unregister the search *`query`* cached at *`version`*, unless it is
+    registered at another version meanwhile by a new search.
+
+    Returns whether it is unregistered.
+    """
+    with redis_client.pipeline() as pipeline:
+        try:
+            pipeline.watch(CACHED_QUERIES)
+            if pipeline.hget(CACHED_QUERIES, query) != str(version):
+                return False
+            pipeline.multi()
+            pipeline.hdel(CACHED_QUERIES, query)
+            pipeline.execute()
+        except WatchError:
+            # the registered queries changed, it is checked next time
+            return False
+    return True
+
+
+def get_cached_queries() -> Dict[str, int]:
+    """ Get the registered search queries and their cached versions """
+    return {query: int(version) for query, version
+            in redis_client.hgetall(CACHED_QUERIES).items()}
+
+
+def start_search_task(cache_key: str, task_id: str) -> str:
+    """
+    Mark the task *`task_id`* as the search in flight for *`cache_key`*
+    unless another task is.
+
+    Returns the id of the task in flight, start the task only if
+    it is *`task_id`*.
+    """
+    key = f"task:{cache_key}"
+    while not redis_client.set(key, task_id, nx=True, ex=SEARCH_TASK_TTL):
+        if (running := redis_client.get(key)) is not None:
+            return running
+    return task_id
+
+
+def get_search_task(cache_key: str) -> str | None:
+    """ Get the id of the search task in flight for *`cache_key`* """
+    return redis_client.get(f"task:{cache_key}")
+
+
+def finish_search_task(cache_key: str) -> None:
+    """ Unmark the search task in flight for *`cache_key`* """
+    redis_client.delete(f"task:{cache_key}")
+
+
+async def astart_search_task(cache_key: str, task_id: str) -> str:
+    """ `start_search_task` awaited on the event loop """
+    key = f"task:{cache_key}"
+    while not await async_redis_client.set(key, task_id, nx=True,
+                                           ex=SEARCH_TASK_TTL):
+        if (running := await async_redis_client.get(key)) is not None:
+            return running
+    return task_id
+
+
+def cancel_search_task(task_id: str) -> None:
+    """ Ask the search task *`task_id`* to stop at its next checkpoint """
+    redis_client.set(f"cancel:{task_id}", 1, ex=SEARCH_TASK_TTL)
+
+
+def is_cancelled(task_id: str) -> bool:
+    """ Check if the search task *`task_id`* is asked to stop """
+    return bool(redis_client.exists(f"cancel:{task_id}"))
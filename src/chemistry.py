@@ -0,0 +1,161 @@
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from hashlib import sha256
+from os import getenv
+from typing import Callable, List, NamedTuple, TypeVar
+from rdkit.Chem import (Mol, MolFromSmarts, MolFromSmiles, MolToSmiles,
+                        PatternFingerprint)
+from rdkit.Chem.rdFingerprintGenerator import GetMorganGenerator
+from rdkit.DataStructs import BitVectToBinaryText
+from src.metrics import stage
+
+# number of bits in the pattern fingerprint of a molecule
+FINGERPRINT_SIZE = 2048
+# number of bits and radius of the Morgan fingerprint of a molecule
+MORGAN_SIZE = 2048
+MORGAN_RADIUS = 2
+# number of threads parsing and matching molecules for the web handlers
+RDKIT_WORKERS = int(getenv("RDKIT_WORKERS", "4"))
+# number of parsed search queries kept by every process
+QUERY_CACHE_SIZE = int(getenv("QUERY_CACHE_SIZE", "1024"))
+# search queries starting with it are SMARTS patterns, not SMILES
+SMARTS_PREFIX = "smarts:"
+
+rdkit_executor = ThreadPoolExecutor(RDKIT_WORKERS,
+                                    thread_name_prefix="rdkit")
+T = TypeVar("T")
+
+
+async def run_rdkit(function: Callable[..., T], *args) -> T:
+    """
+    Await *`function`* called with *`args`* in the RDKit threads,
+    so parsing and matching molecules does not block the event loop
+    and at most `RDKIT_WORKERS` of them run at once.
+    """
+    return await get_running_loop().run_in_executor(rdkit_executor,
+                                                    function, *args)
+
+
+def pattern_fingerprint(mol: Mol) -> bytes:
+    """
+    Get the RDKit pattern fingerprint of *`mol`* packed into bytes.
+
+    Every bit set in the fingerprint of a substructure is also set
+    in the fingerprint of a molecule that contains it.
+    """
+    fingerprint = PatternFingerprint(mol, fpSize=FINGERPRINT_SIZE)
+    return BitVectToBinaryText(fingerprint)
+
+
+morgan_generator = GetMorganGenerator(radius=MORGAN_RADIUS,
+                                      fpSize=MORGAN_SIZE)
+
+
+def morgan_fingerprint(mol: Mol) -> bytes:
+    """ Get the Morgan fingerprint of *`mol`* packed into bytes,
+    compared by Tanimoto similarity """
+    return BitVectToBinaryText(morgan_generator.GetFingerprint(mol))
+
+
+class Query(NamedTuple):
+    """ A parsed substructure search query """
+    mol: Mol
+    # pattern fingerprint as bytes and as an integer
+    fingerprint: bytes
+    bits: int
+
+
+def smarts_query(smarts: str) -> str:
+    """ The search query of a *`smarts`* pattern """
+    return SMARTS_PREFIX + smarts
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def parse_query(query: str) -> Query | None:
+    """
+    Parse a substructure search *`query`*, a SMILES string
+    or a `smarts_query`, and get its pattern fingerprint.
+
+    Returns `None` for an invalid query. The last `QUERY_CACHE_SIZE`
+    queries are kept, so the web handlers and the tasks of a process
+    parse and fingerprint a popular query once.
+    """
+    with stage("query_parse"):
+        if query.startswith(SMARTS_PREFIX):
+            mol = MolFromSmarts(query[len(SMARTS_PREFIX):])
+        else:
+            mol = MolFromSmiles(query)
+        if mol is None:
+            return None
+        fingerprint = pattern_fingerprint(mol)
+    return Query(mol, fingerprint, int.from_bytes(fingerprint, 'big'))
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def canonical_query(query: str) -> str:
+    """ Get the `canonical_smiles` of a SMILES *`query`*,
+    a `smarts_query` is kept as it is """
+    if query.startswith(SMARTS_PREFIX):
+        return query
+    return canonical_smiles(query)
+
+
+def screen(fingerprint: bytes | int | None, query: int) -> bool:
+    """
+    Check that *`fingerprint`* has all the bits of the *`query`*
+    fingerprint, so the molecule may contain the query substructure.
+
+    A molecule without a stored fingerprint always passes the screen.
+    """
+    if fingerprint is None:
+        return True
+    if isinstance(fingerprint, bytes):
+        fingerprint = int.from_bytes(fingerprint, 'big')
+    return fingerprint & query == query
+
+
+def smiles_hash(canonical: str) -> str:
+    """ Hash of a canonical SMILES string for the unique index """
+    return sha256(canonical.encode()).hexdigest()
+
+
+def canonical_smiles(smiles: str) -> str:
+    """ Get the canonical form of *`smiles`*, or itself if invalid """
+    mol = MolFromSmiles(smiles)
+    return smiles if mol is None else MolToSmiles(mol)
+
+
+def molecule_hash(smiles: str) -> str | None:
+    """ Get the `smiles_hash` of *`smiles`*, or `None` if invalid """
+    mol = MolFromSmiles(smiles)
+    return None if mol is None else smiles_hash(MolToSmiles(mol))
+
+
+def molecule_values(smiles: str, mol: Mol | None = None) -> dict | None:
+    """
+    Column values of a stored molecule computed from a `smiles` string,
+    pass the already parsed `mol` to skip parsing it again.
+
+    Returns `None` for an invalid SMILES string.
+    """
+    if mol is None:
+        mol = MolFromSmiles(smiles)
+    if mol is None:
+        return None
+    canonical = MolToSmiles(mol)
+    return {'smiles': smiles,
+            'canonical_smiles': canonical,
+            'smiles_hash': smiles_hash(canonical),
+            'fingerprint': pattern_fingerprint(mol),
+            'binary': mol.ToBinary(),
+            'morgan': morgan_fingerprint(mol)}
+
+
+def parse_batch(lines: List[str]) -> List[dict | None]:
+    """
+    Get the `molecule_values` of SMILES strings of *`lines`*.
+
+    Runs in the import worker processes.
+    """
+    return [molecule_values(smiles) for smiles in lines]
@@ -1,9 +1,20 @@
+from asyncio import to_thread
+from contextlib import contextmanager
+from contextvars import ContextVar
 from os import getenv
-from typing import List
-from sqlalchemy import create_engine, URL, String
-from sqlalchemy import select, insert  # , text, exc
+from typing import (Callable, Dict, List, Tuple, Sequence, Generator,
+                    TypeVar)
+from sqlalchemy import create_engine, URL, String, LargeBinary, event
+from sqlalchemy import (select, insert, update, delete, inspect, text, or_,
+                        func, cast, literal_column)  # , exc
+from sqlalchemy.dialects.postgresql import BIT
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.orm import (Session, DeclarativeBase, Mapped,
                             mapped_column)  # , relationship
+from rdkit.Chem import Mol, MolFromSmiles, MolToSmiles
+from src.chemistry import (molecule_values, screen, smiles_hash,
+                           FINGERPRINT_SIZE)
 from src.logger import logger
 
 # engine = create_engine("postgresql+psycopg2://"
@@ -17,13 +28,43 @@ if getenv("DB_HOST") == 'postgres':
         host=getenv("DB_HOST"),
         database=getenv("DB_NAME"),
     )
-    engine = create_engine(url_object)
+    # connections kept by every process, a request uses one of them
+    pool_options = {
+        'pool_size': int(getenv("DB_POOL_SIZE", "5")),
+        'max_overflow': int(getenv("DB_MAX_OVERFLOW", "10")),
+        'pool_timeout': int(getenv("DB_POOL_TIMEOUT", "30")),
+        # seconds before a connection is opened again
+        'pool_recycle': int(getenv("DB_POOL_RECYCLE", "1800")),
+        # test a connection when it is taken from the pool
+        'pool_pre_ping': getenv("DB_POOL_PRE_PING", "true").lower()
+        in ("1", "true", "yes", "on"),
+    }
+    engine = create_engine(url_object, **pool_options)
+    # psycopg has an async mode for the web handlers
+    async_engine: AsyncEngine | None = create_async_engine(url_object,
+                                                           **pool_options)
     logger.debug(f'Connection URL = {url_object}, engine = {engine}')
 else:
     engine = create_engine("sqlite:///..\\..\\SMILESstorage.db")
     # , echo=True)
+    # no async SQLite driver is installed
+    async_engine = None
     logger.debug(f'Connection engine = {engine}')
 
+    @event.listens_for(engine, "connect")
+    def create_functions(dbapi_connection, connection_record):
+        """ SQLite runs `fp_contains` as a Python function """
+        dbapi_connection.create_function(
+            "fp_contains", 2,
+            lambda fp, query: screen(fp, int.from_bytes(query, 'big')),
+            deterministic=True)
+
+# INSERT ... ON CONFLICT DO NOTHING skips already stored molecules
+if engine.dialect.name == 'postgresql':
+    from sqlalchemy.dialects.postgresql import insert as insert_new
+else:
+    from sqlalchemy.dialects.sqlite import insert as insert_new
+
 
 class Base(DeclarativeBase):
     pass
@@ -34,12 +75,86 @@ class Molecules(Base):
     __tablename__ = "molecules"
     id: Mapped[int] = mapped_column(primary_key=True)
     smiles: Mapped[str] = mapped_column(String(2778), nullable=False)
+    # pattern fingerprint for substructure screening, not sent to clients
+    fingerprint: Mapped[bytes | None] = mapped_column(LargeBinary,
+                                                      deferred=True)
+    # parsed RDKit molecule pickled by `Mol.ToBinary()`
+    binary: Mapped[bytes | None] = mapped_column(LargeBinary, deferred=True)
+    # Morgan fingerprint for similarity search
+    morgan: Mapped[bytes | None] = mapped_column(LargeBinary, deferred=True)
+    # RDKit canonical SMILES, the same for all SMILES of a molecule
+    canonical_smiles: Mapped[str | None] = mapped_column(String(2778),
+                                                         deferred=True)
+    # hash of canonical SMILES, unique for every stored molecule
+    smiles_hash: Mapped[str | None] = mapped_column(String(64), unique=True,
+                                                    index=True, deferred=True)
 
     def __repr__(self) -> str:
         return f"<{self.id!r}. {self.smiles!r}>"
 
 
-Molecules.metadata.create_all(engine, checkfirst=True)
+# log of written molecule ids for incremental library refresh
+class MoleculeChanges(Base):
+    __tablename__ = "molecule_changes"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    molecule_id: Mapped[int] = mapped_column(nullable=False)
+
+
+class ChangesPruned(Exception):
+    """ The changes after a version were pruned from the log,
+    the molecules are read again instead """
+
+
+def add_missing_columns(table) -> None:
+    """
+    `create_all` skips tables that already exist, so add the nullable
+    columns introduced after the table was created.
+    """
+    with engine.begin() as connection:
+        existing = {column['name'] for column in
+                    inspect(connection).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(engine.dialect)
+                # quote names such as "binary" reserved in PostgreSQL
+                name = engine.dialect.identifier_preparer.quote(column.name)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD '
+                                        f'COLUMN {name} {column_type}'))
+                logger.info(f'Added column {table.name}.{column.name}')
+
+
+def create_fingerprint_bits() -> None:
+    """
+    PostgreSQL keeps the fingerprints as bit strings in the generated
+    column `fingerprint_bits` too, so `fp_contains(fingerprint_bits,
+    query)` compares them without converting them for every row.
+    It is true when the fingerprint has all the bits of the query
+    fingerprint, or is NULL.
+    """
+    bits = f"bit({FINGERPRINT_SIZE})"
+    with engine.begin() as connection:
+        connection.execute(text(f"""
+            ALTER TABLE molecules ADD COLUMN IF NOT EXISTS fingerprint_bits
+                {bits} GENERATED ALWAYS AS
+                (('x' || encode(fingerprint, 'hex'))::{bits}) STORED"""))
+        connection.execute(text(
+            "DROP FUNCTION IF EXISTS fp_contains(bytea, bytea)"))
+        connection.execute(text(f"""
+            CREATE OR REPLACE FUNCTION fp_contains(fp {bits}, query {bits})
+            RETURNS boolean LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+                SELECT fp IS NULL OR fp & query = query
+            $$"""))
+
+
+def fp_contains(query: bytes):
+    """ Condition of the molecules whose pattern fingerprints have all
+    the bits of the *`query`* fingerprint, or are not computed """
+    if engine.dialect.name == 'postgresql':
+        bits = format(int.from_bytes(query, 'big'), f'0{len(query) * 8}b')
+        return func.fp_contains(literal_column("molecules.fingerprint_bits"),
+                                cast(bits, BIT(FINGERPRINT_SIZE)))
+    return func.fp_contains(Molecules.fingerprint, query)
+
 
 '''
 Just as a matter of curiosity, the longest SMILES string created so far
@@ -48,17 +163,68 @@ string of 2778 characters.
 '''
 
 
+class UnitOfWork:
+    """
+    One session on one connection for all DAO calls of a request,
+    opened by the first of them and closed at the end of the request.
+    """
+
+    def __init__(self) -> None:
+        self.connection = None
+        self.current: Session | None = None
+
+    def session(self) -> Session:
+        if self.current is None:
+            self.connection = engine.connect()
+            self.current = Session(bind=self.connection,
+                                   expire_on_commit=False)
+        return self.current
+
+    def close(self) -> None:
+        if self.current is not None:
+            self.current.close()
+            self.connection.close()
+            self.current = self.connection = None
+
+
+# the unit of work of the current request
+current_work: ContextVar[UnitOfWork | None] = ContextVar("current_work",
+                                                         default=None)
+
+
 class BaseDAO:
     model = None
 
+    @staticmethod
+    @contextmanager
+    def session() -> Generator[Session, None, None]:
+        """ Use the session of the current `UnitOfWork`, or a new one """
+        if (work := current_work.get()) is not None:
+            yield work.session()
+        else:
+            with Session(engine, expire_on_commit=False) as session:
+                yield session
+        # context calls session.close()
+
     @classmethod
-    def create(cls, **data: dict) -> None:
-        new_object = cls.model(**data)
-        # create session and add objects
-        with Session(engine) as session, session.begin():
-            session.add(new_object)
-        # inner context calls session.commit(), if there were no exceptions
-        # outer context calls session.close()
+    @contextmanager
+    def transaction(cls) -> Generator[Session, None, None]:
+        """ Use a `session` committed at the end, if there were no
+        exceptions, or rolled back """
+        with cls.session() as session:
+            try:
+                yield session
+            except BaseException:
+                session.rollback()
+                raise
+            session.commit()
+
+    @classmethod
+    def create(cls, **data: dict):
+        """ Insert an object and get it back in the same statement """
+        with cls.transaction() as session:
+            statement = insert(cls.model).values(**data).returning(cls.model)
+            return session.scalars(statement).one()
 
     @classmethod
     def all(cls, limit: int = 100, offset: int = 0) -> Molecules:
@@ -70,7 +236,7 @@ class BaseDAO:
         first results with *`offset`*.
         '''
         # create session and get objects
-        with Session(engine) as session:  # , session.begin():
+        with cls.session() as session:  # , session.begin():
             statement = select(cls.model).offset(offset).limit(limit)
             results = session.scalars(statement).all()
         # context calls session.close()
@@ -91,7 +257,7 @@ class BaseDAO:
         # sqlalchemy.exc.NoResultFound: No row was found when one was required
         # sqlalchemy.exc.MultipleResultsFound: Multiple rows were found
         # when exactly one was required
-        with Session(engine) as session:  # , session.begin():
+        with cls.session() as session:  # , session.begin():
             query = select(cls.model).filter_by(**data)
             result = session.scalars(query).one()
         # context calls session.close()
@@ -102,7 +268,7 @@ class BaseDAO:
     @classmethod
     def filter(cls, **data: dict) -> Molecules:
         # create session and get objects
-        with Session(engine) as session:  # , session.begin():
+        with cls.session() as session:  # , session.begin():
             query = select(cls.model).filter_by(**data)
             result = session.scalars(query).all()
         # context calls session.close()
@@ -111,7 +277,7 @@ class BaseDAO:
     @classmethod
     def last(cls, limit: int = 1, **data: dict) -> Molecules:
         # create session and get objects
-        with Session(engine) as session:  # , session.begin():
+        with cls.session() as session:  # , session.begin():
             query = (select(cls.model).filter_by(**data)
                      .order_by(cls.model.id.desc())
                      .limit(limit))
@@ -124,25 +290,59 @@ class BaseDAO:
 
     @classmethod
     def delete(cls, id: int) -> Molecules:
-        """ create session and delete objects """
-        with Session(engine) as session, session.begin():
-            item = session.get_one(cls.model, id)
-            """
-            Return exactly one instance based on the given primary
-            key identifier, or raise an exception if not found.
+        """
+        Delete an object by id and get it back in the same statement.
 
-            Raises sqlalchemy.orm.exc.NoResultFound if the query
-            selects no rows. """
+        Raises sqlalchemy.orm.exc.NoResultFound if the query
+        selects no rows.
+        """
+        with cls.transaction() as session:
+            statement = (delete(cls.model).where(cls.model.id == id)
+                         .returning(cls.model))
             # sqlalchemy.exc.NoResultFound: No row was found
             # when one was required
-            session.delete(item)
-        # context calls session.close()
-        return item
+            return session.scalars(statement).one()
+
+
+# the columns of stored molecules kept by the search library
+LIBRARY_COLUMNS = ('smiles', 'fingerprint', 'binary')
+# number of molecule ids looked up by one query
+LOOKUP_SIZE = 10000
 
 
 class MoleculeDAO(BaseDAO):
     model = Molecules
 
+    @staticmethod
+    def values(smiles: str, mol: Mol | None = None) -> dict:
+        """
+        Column values computed from a `smiles` string,
+        pass the already parsed `mol` to skip parsing it again.
+        """
+        values = molecule_values(smiles, mol)
+        if values is None:
+            return {'smiles': smiles, 'canonical_smiles': None,
+                    'smiles_hash': None, 'fingerprint': None,
+                    'binary': None, 'morgan': None}
+        return values
+
+    @staticmethod
+    def log_changes(session: Session, *ids: int) -> None:
+        """ Record the written molecule `ids` in the `session` """
+        if ids:
+            session.execute(insert(MoleculeChanges),
+                            [{'molecule_id': id} for id in ids])
+
+    @classmethod
+    def create(cls, mol: Mol | None = None, **data: dict) -> Molecules:
+        if 'smiles' in data:
+            data.update(cls.values(data['smiles'], mol))
+        with cls.transaction() as session:
+            statement = insert(cls.model).values(**data).returning(cls.model)
+            instance = session.scalars(statement).one()
+            cls.log_changes(session, instance.id)
+        return instance
+
     @classmethod
     def smiles(cls, limit: int = 100, offset: int = 0) -> List[str]:
         """ Get stored SMILES strings
@@ -153,7 +353,7 @@ class MoleculeDAO(BaseDAO):
         And the same way, you can skip the
         first results with *`offset`*.
         """
-        with Session(engine) as session:  # , session.begin():
+        with cls.session() as session:  # , session.begin():
             statement = (select(cls.model.smiles)
                          .offset(offset)
                          .limit(limit))
@@ -161,38 +361,398 @@ class MoleculeDAO(BaseDAO):
         # context calls session.close()
         return results
 
+    @staticmethod
+    def read_hits(session: Session,
+                  ids: Sequence[int]) -> List[Tuple[int, str]]:
+        """ Get the pairs of id and SMILES string of the stored molecules
+        with *`ids`* in their order, the deleted molecules are missing """
+        smiles: Dict[int, str] = {}
+        for start in range(0, len(ids), LOOKUP_SIZE):
+            statement = (select(Molecules.id, Molecules.smiles)
+                         .where(Molecules.id.in_(
+                             ids[start:start + LOOKUP_SIZE])))
+            smiles.update(session.execute(statement).tuples().all())
+        return [(id, smiles[id]) for id in ids if id in smiles]
+
+    @classmethod
+    def hits(cls, ids: Sequence[int]) -> List[Tuple[int, str]]:
+        """ Get the search hits of the molecules with *`ids`*,
+        see `read_hits` """
+        with cls.session() as session:
+            return cls.read_hits(session, ids)
+
+    @classmethod
+    def library(cls, ids: Sequence[int] | None = None,
+                shard: Tuple[int, int] | None = None,
+                columns: Sequence[str] = LIBRARY_COLUMNS
+                ) -> List[Tuple[int, str, bytes | None, bytes | None]]:
+        """ Get stored molecules ordered by id as tuples of id, SMILES,
+        pattern fingerprint and binary molecule, or of id and other
+        *`columns`*
+
+        Get all of them, or only the molecules with the given *`ids`*.
+        With *`shard`* as `(index, count)` get only the molecules
+        with `id % count == index`.
+        """
+        with cls.session() as session:  # , session.begin():
+            statement = (select(cls.model.id,
+                                *(getattr(cls.model, c) for c in columns))
+                         .order_by(cls.model.id))
+            if ids is not None:
+                statement = statement.where(cls.model.id.in_(ids))
+            if shard is not None:
+                index, count = shard
+                statement = statement.where(cls.model.id % count == index)
+            results = session.execute(statement).all()
+        # context calls session.close()
+        return [tuple(row) for row in results]
+
+    @classmethod
+    def scan(cls, batch_size: int = 1000,
+             shard: Tuple[int, int] | None = None,
+             ids: range | None = None,
+             fingerprint: bytes | Sequence[bytes] | None = None,
+             columns: Sequence[str] = LIBRARY_COLUMNS
+             ) -> Generator[List[Tuple[int, str, bytes | None, bytes | None]],
+                            None, None]:
+        """ Scan all stored molecules ordered by id in batches
+        of *`batch_size`* rows, the same tuples as `library` gives
+
+        Every batch is read by its own query after the last id
+        of the previous batch, so only one batch is kept in memory.
+        *`shard`* and *`columns`* work the same way as in `library`,
+        and *`ids`* limits the scan to a range of molecule ids.
+
+        With a query pattern *`fingerprint`* the database returns only
+        the molecules whose fingerprints have all of its bits, with
+        a list of them the molecules having all bits of any of them.
+        """
+        if isinstance(fingerprint, bytes):
+            fingerprint = [fingerprint]
+        last_id = None if ids is None else ids.start - 1
+        while True:
+            with Session(engine) as session:
+                statement = (select(cls.model.id,
+                                    *(getattr(cls.model, c) for c in columns))
+                             .order_by(cls.model.id)
+                             .limit(batch_size))
+                if last_id is not None:
+                    statement = statement.where(cls.model.id > last_id)
+                if ids is not None:
+                    statement = statement.where(cls.model.id < ids.stop)
+                if shard is not None:
+                    index, count = shard
+                    statement = statement.where(
+                        cls.model.id % count == index)
+                if fingerprint:
+                    statement = statement.where(or_(*(
+                        fp_contains(query) for query in fingerprint)))
+                rows = session.execute(statement).all()
+            if not rows:
+                return
+            yield [tuple(row) for row in rows]
+            last_id = rows[-1].id
+
+    @classmethod
+    def count(cls) -> int:
+        """ Get the number of stored molecules """
+        with cls.session() as session:
+            return session.scalar(select(func.count(cls.model.id)))
+
+    @classmethod
+    def id_range(cls) -> Tuple[int, int] | None:
+        """ Get the smallest and the largest id of stored molecules """
+        with cls.session() as session:
+            statement = select(func.min(cls.model.id), func.max(cls.model.id))
+            first, last = session.execute(statement).one()
+        return None if first is None else (first, last)
+
+    @classmethod
+    def version(cls) -> int:
+        """ Get the number of the last change of stored molecules """
+        with cls.session() as session:
+            statement = select(func.max(MoleculeChanges.id))
+            return session.scalar(statement) or 0
+
     @classmethod
-    def insert(cls, *smiles: str) -> Molecules | int:
+    def changes(cls, version: int) -> Tuple[int, List[int]]:
+        """
+        Get the number of the last change and the ids of molecules
+        written after the change number *`version`*.
+
+        Raises `ChangesPruned` when some of them are not logged any more.
+        """
+        with cls.session() as session:
+            statement = (select(MoleculeChanges.id,
+                                MoleculeChanges.molecule_id)
+                         .where(MoleculeChanges.id >= version)
+                         .order_by(MoleculeChanges.id))
+            rows = session.execute(statement).all()
+        if not rows:
+            return version, []
+        # the change *`version`* itself is kept by `prune_changes`
+        if rows[0].id == version:
+            rows = rows[1:]
+        elif rows[0].id > max(version, 1):
+            raise ChangesPruned(version)
+        if not rows:
+            return version, []
+        return rows[-1].id, list(dict.fromkeys(row.molecule_id
+                                               for row in rows))
+
+    @classmethod
+    def prune_changes(cls, version: int) -> int:
+        """
+        Delete the changes before the change number *`version`*,
+        the changes after it are still read. Returns the number
+        of deleted changes.
+        """
+        with cls.transaction() as session:
+            statement = (delete(MoleculeChanges)
+                         .where(MoleculeChanges.id < version))
+            return session.execute(statement).rowcount
+
+    @classmethod
+    def insert(cls, *smiles: str,
+               mols: Sequence[Mol] | None = None) -> Molecules | int:
         """
         - Store one `smiles` string of a chemical compound.
 
         - Store many `smiles` strings as arguments separated by ` , `.
+
+        - Pass the parsed molecules of `smiles` as `mols`
+        to skip parsing them again.
+
+        - Molecules stored already are skipped.
         """
-        with Session(engine) as session, session.begin():
-            values = [{'smiles': s} for s in smiles]
-            statement = insert(cls.model).values(values).returning(cls.model)
+        if mols is None:
+            mols = [None] * len(smiles)
+        with cls.transaction() as session:
+            values = [cls.values(s, m) for s, m in zip(smiles, mols)]
+            statement = (insert_new(cls.model).values(values)
+                         .on_conflict_do_nothing(
+                             index_elements=['smiles_hash'])
+                         .returning(cls.model))
             result = session.execute(statement).all()
+            cls.log_changes(session, *(row[0].id for row in result))
             # session.add(instance)
             return result
         # inner context calls session.commit(), if there were no exceptions
         # outer context calls session.close()
 
     @classmethod
-    def update(cls, id: int, smiles: str) -> None:
-        """ create session and update an object by id """
+    def find(cls, smiles: str, mol: Mol | None = None) -> Molecules | None:
+        """
+        Get the stored molecule with the same canonical SMILES
+        as *`smiles`* by the unique index, or `None`.
+
+        Pass the already parsed *`mol`* to skip parsing it again.
+        """
+        if mol is None:
+            mol = MolFromSmiles(smiles)
+        if mol is None:
+            return None
+        with cls.session() as session:
+            query = (select(cls.model)
+                     .where(cls.model.smiles_hash
+                            == smiles_hash(MolToSmiles(mol))))
+            return session.scalars(query).one_or_none()
+
+    @classmethod
+    def bulk_insert(cls, values: Sequence[dict]) -> int:
+        """
+        Store many rows of column *`values`* as `values` gives them,
+        with PostgreSQL `COPY` or batched `executemany` on other databases.
+        Molecules stored already are skipped.
+
+        Returns the number of stored rows.
+        """
+        if not values:
+            return 0
         with Session(engine) as session, session.begin():
-            instance = session.get_one(cls.model, id)
-            """
-            Return exactly one instance based on the given
-            primary key identifier, or raise an exception if not found.
+            if engine.dialect.name == 'postgresql':
+                ids = cls.copy(session, values)
+            else:
+                statement = (insert_new(cls.model)
+                             .on_conflict_do_nothing(
+                                 index_elements=['smiles_hash'])
+                             .returning(cls.model.id))
+                ids = session.scalars(statement, values).all()
+            cls.log_changes(session, *ids)
+        return len(ids)
+
+    @staticmethod
+    def copy(session: Session, values: Sequence[dict]) -> List[int]:
+        """ `COPY` rows into a temporary table and move them
+        to the molecules table, returning their new ids """
+        names = ['smiles', 'canonical_smiles', 'smiles_hash',
+                 'fingerprint', 'binary', 'morgan']
+        quote = engine.dialect.identifier_preparer.quote
+        columns = ', '.join(quote(name) for name in names)
+        cursor = session.connection().connection.cursor()
+        cursor.execute('CREATE TEMP TABLE molecules_import (n serial, '
+                       'smiles varchar, canonical_smiles varchar, '
+                       'smiles_hash varchar, fingerprint bytea, '
+                       '"binary" bytea, morgan bytea) ON COMMIT DROP')
+        with cursor.copy(f'COPY molecules_import ({columns}) '
+                         'FROM STDIN') as copy:
+            for row in values:
+                copy.write_row([row[name] for name in names])
+        cursor.execute(f'INSERT INTO molecules ({columns}) '
+                       f'SELECT {columns} FROM molecules_import ORDER BY n '
+                       'ON CONFLICT (smiles_hash) DO NOTHING RETURNING id')
+        return [id for id, in cursor.fetchall()]
+
+    @classmethod
+    def update(cls, id: int, smiles: str,
+               mol: Mol | None = None) -> Molecules:
+        """
+        Update an object by id and get it back in the same statement.
 
-            Raises sqlalchemy.orm.exc.NoResultFound if the query
-            selects no rows. """
+        Raises sqlalchemy.orm.exc.NoResultFound if the query
+        selects no rows.
+        """
+        with cls.transaction() as session:
+            statement = (update(cls.model).where(cls.model.id == id)
+                         .values(**cls.values(smiles, mol))
+                         .returning(cls.model))
             # sqlalchemy.exc.NoResultFound: No row was found
             # when one was required
-            # session.update(instance)
-            instance.smiles = smiles
-            # session.add(instance)
-        # inner context calls session.commit(), if there were no exceptions
-        # outer context calls session.close()
-        # return instance
+            instance = session.scalars(statement).one()
+            cls.log_changes(session, id)
+        return instance
+
+    @classmethod
+    def delete(cls, id: int) -> Molecules:
+        """ `BaseDAO.delete` recording the change """
+        with cls.transaction() as session:
+            statement = (delete(cls.model).where(cls.model.id == id)
+                         .returning(cls.model))
+            instance = session.scalars(statement).one()
+            cls.log_changes(session, id)
+        return instance
+
+    @classmethod
+    def backfill(cls, batch_size: int = 1000) -> int:
+        """
+        Compute the canonical SMILES, fingerprints and binary molecules
+        of rows stored without any of them, *`batch_size`* rows
+        per transaction.
+
+        Rows duplicating a molecule stored earlier are left without
+        the hash of canonical SMILES, so the unique index can be built.
+
+        Returns the number of updated rows.
+        """
+        updated, last_id = 0, 0
+        missing = or_(cls.model.fingerprint.is_(None),
+                      cls.model.binary.is_(None),
+                      cls.model.canonical_smiles.is_(None),
+                      cls.model.morgan.is_(None))
+        while True:
+            with Session(engine) as session, session.begin():
+                statement = (select(cls.model.id, cls.model.smiles)
+                             .where(missing, cls.model.id > last_id)
+                             .order_by(cls.model.id)
+                             .limit(batch_size))
+                rows = session.execute(statement).all()
+                if not rows:
+                    break
+                # rows with invalid SMILES strings are left as they are
+                values = [{'id': id, **cls.values(smiles)}
+                          for id, smiles in rows]
+                values = [row for row in values if row['binary']]
+                hashes = [row['smiles_hash'] for row in values]
+                stored = dict(session.execute(
+                    select(cls.model.smiles_hash, cls.model.id)
+                    .where(cls.model.smiles_hash.in_(hashes))).all())
+                for row in values:
+                    # the hash of the row itself is kept
+                    if stored.setdefault(row['smiles_hash'],
+                                         row['id']) != row['id']:
+                        row['smiles_hash'] = None
+                if values:
+                    session.execute(update(cls.model), values)
+                    cls.log_changes(session, *(row['id'] for row in values))
+            updated += len(values)
+            last_id = rows[-1].id
+        if updated:
+            logger.info(f'Backfilled {updated} molecules')
+        return updated
+
+
+T = TypeVar("T")
+
+
+class AsyncMoleculeDAO:
+    """
+    Reads of stored molecules awaited by the web handlers.
+
+    They run in an `AsyncSession` if there is an `async_engine`,
+    otherwise in a thread so the event loop is not blocked either.
+    """
+    model = Molecules
+
+    @classmethod
+    async def run(cls, query: Callable[[Session], T]) -> T:
+        """ Await *`query`* called with a session """
+        if async_engine is None:
+            def run_sync() -> T:
+                with Session(engine) as session:
+                    return query(session)
+            return await to_thread(run_sync)
+        async with AsyncSession(async_engine) as session:
+            return await session.run_sync(query)
+
+    @classmethod
+    async def all(cls, limit: int = 100,
+                  offset: int = 0) -> Sequence[Molecules]:
+        """ `MoleculeDAO.all` """
+        statement = select(cls.model).offset(offset).limit(limit)
+        return await cls.run(lambda session:
+                             session.scalars(statement).all())
+
+    @classmethod
+    async def get(cls, **data: dict) -> Molecules:
+        """ `MoleculeDAO.get`, raises `NoResultFound` """
+        statement = select(cls.model).filter_by(**data)
+        return await cls.run(lambda session:
+                             session.scalars(statement).one())
+
+    @classmethod
+    async def find(cls, hash: str) -> Molecules | None:
+        """ Get the stored molecule with the `smiles_hash` *`hash`* """
+        statement = select(cls.model).where(cls.model.smiles_hash == hash)
+        return await cls.run(lambda session:
+                             session.scalars(statement).one_or_none())
+
+    @classmethod
+    async def hits(cls, ids: Sequence[int]) -> List[Tuple[int, str]]:
+        """ `MoleculeDAO.hits` """
+        return await cls.run(lambda session:
+                             MoleculeDAO.read_hits(session, ids))
+
+    @classmethod
+    async def version(cls) -> int:
+        """ `MoleculeDAO.version` """
+        statement = select(func.max(MoleculeChanges.id))
+        return await cls.run(lambda session:
+                             session.scalar(statement) or 0)
+
+
+def migrate() -> None:
+    """
+    Create the tables, the columns added later, the functions and
+    the indexes of the stored molecules, and backfill their computed
+    columns.
+
+    Run once by `python -m src.migrate` before the web and worker
+    processes start, they do not change the schema themselves.
+    """
+    Molecules.metadata.create_all(engine, checkfirst=True)
+    add_missing_columns(Molecules.__table__)
+    if engine.dialect.name == 'postgresql':
+        create_fingerprint_bits()
+    MoleculeDAO.backfill()
+    for index in Molecules.__table__.indexes:
+        index.create(engine, checkfirst=True)
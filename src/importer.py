@@ -0,0 +1,106 @@
+import asyncio
+import codecs
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import cpu_count, getenv
+from typing import AsyncIterator, Iterable, List
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+from src.chemistry import parse_batch
+from src.dao import MoleculeDAO
+from src.logger import logger
+
+# number of processes parsing uploaded SMILES strings
+IMPORT_WORKERS = int(getenv("IMPORT_WORKERS", "0")) or cpu_count() or 1
+# number of lines parsed and stored at once
+IMPORT_BATCH_SIZE = int(getenv("IMPORT_BATCH_SIZE", "5000"))
+# bytes of the uploaded file read at once
+READ_CHUNK_SIZE = 1024 * 1024
+
+pool: ProcessPoolExecutor | None = None
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """ Start the import processes on the first upload """
+    global pool
+    if pool is None:
+        pool = ProcessPoolExecutor(IMPORT_WORKERS,
+                                   mp_context=get_context("spawn"))
+    return pool
+
+
+async def read_lines(file: UploadFile,
+                     chunk_size: int = READ_CHUNK_SIZE
+                     ) -> AsyncIterator[str]:
+    """ Read the stripped non-empty lines of a text *`file`* in chunks """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    rest = ""
+    while chunk := await file.read(chunk_size):
+        *lines, rest = (rest + decoder.decode(chunk)).split("\n")
+        for line in lines:
+            if line := line.strip():
+                yield line
+    if line := (rest + decoder.decode(b"", final=True)).strip():
+        yield line
+
+
+async def iterate(lines: Iterable[str]) -> AsyncIterator[str]:
+    for line in lines:
+        yield line
+
+
+async def batches(lines: AsyncIterator[str],
+                  size: int) -> AsyncIterator[List[str]]:
+    batch = []
+    async for line in lines:
+        batch.append(line)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def store(parsed: list, summary: dict) -> None:
+    """ Store a batch of parsed molecules skipping invalid SMILES
+    strings and duplicates, and count them in the *`summary`* """
+    values, hashes, invalid = [], set(), 0
+    for row in parsed:
+        if row is None:
+            invalid += 1
+        elif row["smiles_hash"] not in hashes:
+            hashes.add(row["smiles_hash"])
+            values.append(row)
+    # the unique index skips the molecules stored already
+    inserted = MoleculeDAO.bulk_insert(values)
+    summary["inserted"] += inserted
+    summary["invalid"] += invalid
+    summary["duplicates"] += len(parsed) - invalid - inserted
+
+
+async def import_molecules(lines: AsyncIterator[str] | Iterable[str],
+                           batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    """
+    Parse SMILES *`lines`* in the import processes and store the valid,
+    new molecules batch by batch, keeping a few batches in memory.
+
+    Batches are stored in order, so the duplicates of molecules
+    from earlier batches are found in the database.
+
+    Returns the numbers of inserted, duplicate and invalid molecules.
+    """
+    if not hasattr(lines, "__aiter__"):
+        lines = iterate(lines)
+    loop = asyncio.get_running_loop()
+    executor = get_pool()
+    summary = {"inserted": 0, "duplicates": 0, "invalid": 0}
+    pending = deque()
+    async for batch in batches(lines, batch_size):
+        pending.append(loop.run_in_executor(executor, parse_batch, batch))
+        if len(pending) > IMPORT_WORKERS:
+            await run_in_threadpool(store, await pending.popleft(), summary)
+    while pending:
+        await run_in_threadpool(store, await pending.popleft(), summary)
+    logger.info(f"Imported molecules {summary}")
+    return summary
@@ -0,0 +1,524 @@
+from bisect import bisect_left
+from heapq import merge
+from itertools import islice
+from os import getenv
+from threading import Event, Lock
+from time import perf_counter, time
+from typing import (Callable, Dict, Generator, Iterable, List, Sequence,
+                    Tuple, TypeVar)
+import numpy as np
+from rdkit.Chem import Mol, MolFromSmiles
+from src.caching import is_cancelled
+from src.chemistry import Query, parse_query, pattern_fingerprint, screen
+from src.dao import ChangesPruned, MoleculeDAO
+from src.logger import logger
+from src.metrics import SearchTimer, stage
+from src.store import (LIBRARY_STORE, Segment, open_segments, read_manifest,
+                       update_store)
+
+# "memory" keeps the library parsed in every search process,
+# "scan" reads the molecules table in batches for every search,
+# "mmap" maps the library store shared by all search processes
+SEARCH_LIBRARY = getenv("SEARCH_LIBRARY", "memory")
+# number of molecules read from the database at once
+SCAN_BATCH_SIZE = int(getenv("SCAN_BATCH_SIZE", "1000"))
+# mapped fingerprints screened at once, their words stay in the CPU cache
+SCREEN_CHUNK_SIZE = 32768
+# molecules screened and matched at once by a search between its hits
+MATCH_CHUNK_SIZE = 1024
+# molecules checked by a search between its checkpoints
+PROGRESS_INTERVAL = int(getenv("SEARCH_PROGRESS_INTERVAL", "10000"))
+
+# parsed molecule and its fingerprint as an integer, or None
+Entry = Tuple[str, Mol | None, int | None]
+# called by a search with the number of molecules checked so far,
+# raises to stop the search
+Checkpoint = Callable[[int], None]
+T = TypeVar("T")
+
+
+def load_mol(smiles: str, binary: bytes | None) -> Mol | None:
+    """ Load a stored molecule from its binary form, or parse SMILES """
+    return Mol(binary) if binary else MolFromSmiles(smiles)
+
+
+def parse_entry(smiles: str, fingerprint: bytes | None,
+                binary: bytes | None) -> Entry:
+    """ Parse a stored molecule row for the library """
+    mol = load_mol(smiles, binary)
+    if mol is not None and fingerprint is None:
+        fingerprint = pattern_fingerprint(mol)
+    if fingerprint is not None:
+        fingerprint = int.from_bytes(fingerprint, 'big')
+    return smiles, mol, fingerprint
+
+
+def read_entries(ids: Sequence[int]
+                 ) -> Generator[Tuple[int, Entry], None, None]:
+    """ Read the stored molecules with *`ids`* in batches and parse them,
+    the deleted molecules are missing """
+    for start in range(0, len(ids), SCAN_BATCH_SIZE):
+        for id, *row in MoleculeDAO.library(ids[start:start +
+                                                SCAN_BATCH_SIZE]):
+            yield id, parse_entry(*row)
+
+
+class SearchStopped(Exception):
+    """ A search task is cancelled or out of its time budget """
+
+
+def task_checkpoint(task_id: str | None, deadline: float | None
+                    ) -> Checkpoint:
+    """ Checkpoint stopping a search past the `time()` *`deadline`*
+    or once its task *`task_id`* is cancelled """
+    def checkpoint(checked: int) -> None:
+        if deadline is not None and time() > deadline:
+            raise SearchStopped("time budget")
+        if task_id is not None and is_cancelled(task_id):
+            raise SearchStopped("cancelled")
+    return checkpoint
+
+
+def event_checkpoint(stopped: Event) -> Checkpoint:
+    """ Checkpoint stopping a search once *`stopped`* is set """
+    def checkpoint(checked: int) -> None:
+        if stopped.is_set():
+            raise SearchStopped("stopped")
+    return checkpoint
+
+
+def checkpoints(items: Iterable[T], checkpoint: Checkpoint | None,
+                interval: int | None = None
+                ) -> Generator[T, None, None]:
+    """ Pass on *`items`* calling *`checkpoint`* after every *`interval`*
+    of them, `PROGRESS_INTERVAL` by default, with their number """
+    if checkpoint is None:
+        yield from items
+        return
+    interval = interval or PROGRESS_INTERVAL
+    for count, item in enumerate(items, 1):
+        yield item
+        if count % interval == 0:
+            checkpoint(count)
+
+
+def match_entries(entries: Iterable[Tuple[int, Entry]], query: Query,
+                  screening: bool = True, timer: SearchTimer | None = None
+                  ) -> Generator[Tuple[int, str], None, None]:
+    """
+    Find the pairs of id and SMILES string of *`entries`* that contain
+    substructure *`query`*, skipping the molecules missing any bit
+    of its fingerprint unless *`screening`* is False.
+
+    The entries are screened and matched `MATCH_CHUNK_SIZE` at a time,
+    so the search is timed by *`timer`*, if it was started before,
+    for every chunk and not for every molecule.
+    """
+    timer = timer or SearchTimer()
+    entries = iter(entries)
+    try:
+        while True:
+            timer.resume()
+            chunk = list(islice(entries, MATCH_CHUNK_SIZE))
+            if not chunk:
+                break
+            timer.scanned += len(chunk)
+            if screening:
+                chunk = [(id, entry) for id, entry in chunk
+                         if screen(entry[2], query.bits)]
+            start = perf_counter()
+            hits = [(id, smiles) for id, (smiles, compound, _) in chunk
+                    if compound is not None
+                    and compound.HasSubstructMatch(query.mol)]
+            timer.matching += perf_counter() - start
+            timer.pause()
+            yield from hits
+    finally:
+        timer.observe()
+
+
+def match_batch(entries: Iterable[Tuple[int, Entry]],
+                queries: Sequence[Query | None], screening: bool = True,
+                timer: SearchTimer | None = None
+                ) -> List[List[Tuple[int, str]]]:
+    """
+    Find the pairs of id and SMILES string of *`entries`* that contain
+    each substructure of *`queries`* in one pass over the entries,
+    every chunk of `MATCH_CHUNK_SIZE` molecules is checked against
+    all queries at once.
+
+    An invalid query, `None`, has no hits.
+    """
+    timer = timer or SearchTimer()
+    timer.resume()
+    hits: List[List[Tuple[int, str]]] = [[] for _ in queries]
+    valid = [(found, query.mol, query.bits if screening else 0)
+             for found, query in zip(hits, queries) if query is not None]
+    entries = iter(entries)
+    while chunk := list(islice(entries, MATCH_CHUNK_SIZE)):
+        timer.scanned += len(chunk)
+        for found, query, bits in valid:
+            candidates = [(id, smiles, compound)
+                          for id, (smiles, compound, fingerprint) in chunk
+                          if compound is not None
+                          and screen(fingerprint, bits)]
+            start = perf_counter()
+            found.extend((id, smiles) for id, smiles, compound in candidates
+                         if compound.HasSubstructMatch(query))
+            timer.matching += perf_counter() - start
+    timer.observe()
+    return hits
+
+
+class MoleculeLibrary:
+    """
+    Stored molecules kept parsed in the memory of a process.
+
+    The library is loaded once and then refreshed with the molecules
+    written after the last change it has seen, so a search does not
+    load or parse the stored molecules again.
+
+    With *`shard`* as `(index, count)` the library keeps only
+    the molecules with `id % count == index`.
+    """
+
+    def __init__(self, shard: Tuple[int, int] | None = None) -> None:
+        self.entries: Dict[int, Entry] = {}
+        self.version: int | None = None
+        self.shard = shard
+        self.lock = Lock()
+        # the entries with their ids in order, listed for `entries_in`
+        self.ordered: Tuple[Dict[int, Entry], List[int]] = ({}, [])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def entries_in(self, ids: range) -> Iterable[Tuple[int, Entry]]:
+        """ Get the entries with *`ids`* by bisecting the ordered ids
+        of the entries, listed again only after they change """
+        entries, order = self.ordered
+        if entries is not self.entries:
+            entries = self.entries
+            order = list(entries)
+            self.ordered = entries, order
+        first = bisect_left(order, ids.start)
+        last = bisect_left(order, ids.stop, first)
+        return ((id, entries[id]) for id in order[first:last])
+
+    def load(self) -> None:
+        """ Load all stored molecules """
+        with self.lock, stage("library_load"):
+            # changes made while loading are applied again by `refresh`
+            version = MoleculeDAO.version()
+            self.entries = {id: parse_entry(*row)
+                            for batch in MoleculeDAO.scan(SCAN_BATCH_SIZE,
+                                                          self.shard)
+                            for id, *row in batch}
+            self.version = version
+        logger.debug(f"Loaded library of {len(self)} molecules, "
+                     f"version {version}")
+
+    def refresh(self) -> None:
+        """ Apply the molecules added, changed or deleted since the last
+        known change, or load the library the first time """
+        if self.version is None:
+            return self.load()
+        try:
+            with self.lock, stage("library_refresh"):
+                version, ids = MoleculeDAO.changes(self.version)
+                if self.shard is not None:
+                    index, count = self.shard
+                    ids = [id for id in ids if id % count == index]
+                if not ids:
+                    self.version = version
+                    return
+                # searches keep iterating over the entries they started with
+                entries = dict(self.entries)
+                for id in ids:
+                    entries.pop(id, None)
+                last_id = max(self.entries, default=0)
+                unordered = False
+                for id, entry in read_entries(ids):
+                    entries[id] = entry
+                    unordered = unordered or id < last_id
+                if unordered:
+                    entries = dict(sorted(entries.items()))
+                self.entries = entries
+                self.version = version
+        except ChangesPruned:
+            # the library is older than the logged changes
+            return self.load()
+        logger.debug(f"Refreshed {len(ids)} library molecules, "
+                     f"version {version}")
+
+    def matches(self, mol: str, screening: bool = True,
+                ids: range | None = None,
+                checkpoint: Checkpoint | None = None
+                ) -> Generator[Tuple[int, str], None, None]:
+        """
+        Find all molecules in the library as pairs of id and SMILES
+        string, ordered by id, that contain substructure *`mol`*
+        as SMILES string, or as SMARTS pattern of a `smarts_query`.
+
+        Molecules missing any bit of the query fingerprint are skipped
+        without matching, unless *`screening`* is False.
+
+        Search only among the molecules with *`ids`* if given.
+        The *`checkpoint`* is called every `PROGRESS_INTERVAL` checked
+        molecules, the search stops with the exception it raises.
+        """
+        query = parse_query(mol)
+        if query is None:
+            return
+        entries: Iterable[Tuple[int, Entry]] = self.entries.items()
+        if ids is not None:
+            entries = self.entries_in(ids)
+        yield from match_entries(checkpoints(entries, checkpoint), query,
+                                 screening)
+
+    def search(self, mol: str, screening: bool = True
+               ) -> Generator[str, None, None]:
+        """ Find the SMILES strings of `matches` """
+        for _, smiles in self.matches(mol, screening):
+            yield smiles
+
+    def batch_matches(self, mols: Sequence[str], screening: bool = True
+                      ) -> List[List[Tuple[int, str]]]:
+        """ Find the `matches` of every substructure of *`mols`*
+        in one pass over the library """
+        queries = [parse_query(mol) for mol in mols]
+        return match_batch(self.entries.items(), queries, screening)
+
+
+class TableScan(MoleculeLibrary):
+    """
+    Stored molecules searched by scanning the molecules table
+    in batches of *`batch_size`* rows, so the memory of a search
+    is the same whatever the size of the table.
+    """
+
+    def __init__(self, batch_size: int = SCAN_BATCH_SIZE) -> None:
+        super().__init__()
+        self.batch_size = batch_size
+
+    def __len__(self) -> int:
+        return MoleculeDAO.count()
+
+    def load(self) -> None:
+        """ Nothing is kept in memory """
+
+    def refresh(self) -> None:
+        """ Every search reads the table as it is """
+
+    def matches(self, mol: str, screening: bool = True,
+                ids: range | None = None,
+                checkpoint: Checkpoint | None = None
+                ) -> Generator[Tuple[int, str], None, None]:
+        query = parse_query(mol)
+        if query is None:
+            return
+        # the database screens the molecules before sending them
+        fingerprint = query.fingerprint if screening else None
+        batches = MoleculeDAO.scan(self.batch_size, ids=ids,
+                                   fingerprint=fingerprint)
+        entries = ((id, (smiles, load_mol(smiles, binary), None))
+                   for batch in checkpoints(batches, checkpoint and (
+                       lambda count: checkpoint(count * self.batch_size)),
+                       max(PROGRESS_INTERVAL // self.batch_size, 1))
+                   for id, smiles, _, binary in batch)
+        # the scanned molecules are the ones sent by the database
+        yield from match_entries(entries, query, screening=False)
+
+    def batch_matches(self, mols: Sequence[str], screening: bool = True
+                      ) -> List[List[Tuple[int, str]]]:
+        queries = [parse_query(mol) for mol in mols]
+        valid = [query for query in queries if query is not None]
+        hits: List[List[Tuple[int, str]]] = [[] for _ in queries]
+        if not valid:
+            return hits
+        # the database sends the molecules passing the screen of any query
+        fingerprints = ([query.fingerprint for query in valid]
+                        if screening else None)
+        for batch in MoleculeDAO.scan(self.batch_size,
+                                      fingerprint=fingerprints):
+            entries = ((id, parse_entry(smiles, fingerprint, binary))
+                       for id, smiles, fingerprint, binary in batch)
+            for found, batch_hits in zip(hits, match_batch(
+                    entries, queries, screening)):
+                found.extend(batch_hits)
+        return hits
+
+
+def screen_segment(segment: Segment, mask: np.ndarray,
+                   queries: Sequence[np.ndarray | None]) -> List[np.ndarray]:
+    """
+    Get the positions of the molecules of *`segment`* in *`mask`*
+    having all bits of each fingerprint of *`queries`* as `uint64`
+    words, all of them for `None`. The fingerprints are read from
+    the mapped file a chunk at a time without copying it.
+    """
+    passed = [mask.copy() for _ in queries]
+    words = [None if query is None else np.flatnonzero(query)
+             for query in queries]
+    for start in range(0, len(segment), SCREEN_CHUNK_SIZE):
+        chunk = segment.fingerprints[start:start + SCREEN_CHUNK_SIZE]
+        for found, query, nonzero in zip(passed, queries, words):
+            if query is not None:
+                block = chunk[:, nonzero]
+                found[start:start + len(chunk)] &= (
+                    (block & query[nonzero]) == query[nonzero]).all(axis=1)
+    return [np.flatnonzero(found) for found in passed]
+
+
+class MappedLibrary(MoleculeLibrary):
+    """
+    Stored molecules searched in the memory-mapped library store,
+    so all search processes share the pages of its files and
+    nothing is loaded or parsed in advance.
+
+    The molecules written since the last change of the store are
+    kept parsed in memory like in `MoleculeLibrary`, until a new
+    version of the store is written by `update_store`.
+    """
+
+    def __init__(self, shard: Tuple[int, int] | None = None,
+                 store: str = LIBRARY_STORE) -> None:
+        super().__init__(shard)
+        self.store = store
+        self.manifest: dict | None = None
+        # mapped segments with the masks of their searched molecules
+        self.segments: List[Tuple[Segment, np.ndarray]] = []
+
+    def __len__(self) -> int:
+        return (sum(int(mask.sum()) for _, mask in self.segments)
+                + len(self.entries))
+
+    def load(self) -> None:
+        """ Map the store, written first if it is not yet """
+        with self.lock, stage("library_load"):
+            if (opened := open_segments(self.store)) is None:
+                update_store(self.store, SCAN_BATCH_SIZE)
+                opened = open_segments(self.store)
+            manifest, segments = opened
+            masks = []
+            # the later segments hide the molecules written again
+            hidden = np.empty(0, dtype=np.int64)
+            for segment in reversed(segments):
+                mask = np.ones(len(segment), dtype=bool)
+                mask[segment.positions(hidden)] = False
+                if self.shard is not None:
+                    index, count = self.shard
+                    mask &= segment.ids % count == index
+                masks.append(mask)
+                hidden = np.union1d(hidden, segment.deleted)
+            self.segments = list(zip(segments, reversed(masks)))
+            self.entries, self.manifest = {}, manifest
+            self.version = manifest["version"]
+        logger.debug(f"Mapped library store of {len(self)} molecules, "
+                     f"version {self.version}")
+        self.refresh()
+
+    def refresh(self) -> None:
+        """ Map a new version of the store, or apply the molecules
+        written since the last change the library has seen """
+        if self.version is None or read_manifest(self.store) != self.manifest:
+            return self.load()
+        try:
+            with self.lock, stage("library_refresh"):
+                version, ids = MoleculeDAO.changes(self.version)
+                if self.shard is not None:
+                    index, count = self.shard
+                    ids = [id for id in ids if id % count == index]
+                if not ids:
+                    self.version = version
+                    return
+                segments = []
+                for segment, mask in self.segments:
+                    mask = mask.copy()
+                    mask[segment.positions(ids)] = False
+                    segments.append((segment, mask))
+                entries = dict(self.entries)
+                for id in ids:
+                    entries.pop(id, None)
+                entries.update(read_entries(ids))
+                self.segments, self.entries = segments, dict(sorted(
+                    entries.items()))
+                self.version = version
+        except ChangesPruned:
+            # the store is older than the logged changes
+            update_store(self.store, SCAN_BATCH_SIZE)
+            return self.load()
+        logger.debug(f"Refreshed {len(ids)} library molecules, "
+                     f"version {version}")
+
+    def candidates(self, queries: Sequence[Query | None], screening: bool,
+                   ids: range | None = None,
+                   timer: SearchTimer | None = None
+                   ) -> Generator[Tuple[int, Entry], None, None]:
+        """ Get the molecules passing the screen of any of *`queries`*,
+        ordered by id, as pairs of id and `Entry`.
+
+        The molecules screened out are counted as scanned by *`timer`*,
+        the others are counted by the search checking them. """
+        words = [np.frombuffer(query.fingerprint, dtype=np.uint64)
+                 if screening else None
+                 for query in queries if query is not None]
+        segments, entries = self.segments, self.entries
+        if not words:
+            return iter(())
+        empty = np.empty(0, dtype=np.int64)
+        found_ids, sources, found = [empty], [empty], [empty]
+        for index, (segment, mask) in enumerate(segments):
+            if ids is not None:
+                mask = (mask & (segment.ids >= ids.start)
+                        & (segment.ids < ids.stop))
+            positions = np.unique(np.concatenate(
+                screen_segment(segment, mask, words)))
+            if timer is not None:
+                timer.scanned += int(np.count_nonzero(mask)) - len(positions)
+            found_ids.append(segment.ids[positions])
+            sources.append(np.full(len(positions), index))
+            found.append(positions)
+        mapped_ids, sources, found = map(np.concatenate,
+                                         (found_ids, sources, found))
+        mapped = ((int(mapped_ids[i]), segments[sources[i]][0], int(found[i]))
+                  for i in np.argsort(mapped_ids, kind="stable"))
+        mapped_entries = ((id, (segment.smiles_at(position),
+                                Mol(segment.mol(position)),
+                                int.from_bytes(segment.fingerprints[position]
+                                               .tobytes(), 'big')))
+                          for id, segment, position in mapped)
+        written = ((id, entry) for id, entry in entries.items()
+                   if ids is None or id in ids)
+        return merge(mapped_entries, written, key=lambda item: item[0])
+
+    def matches(self, mol: str, screening: bool = True,
+                ids: range | None = None,
+                checkpoint: Checkpoint | None = None
+                ) -> Generator[Tuple[int, str], None, None]:
+        query = parse_query(mol)
+        if query is None:
+            return
+        timer = SearchTimer()
+        timer.resume()
+        # only the molecules passing the screen are checked one by one
+        candidates = self.candidates([query], screening, ids, timer)
+        yield from match_entries(checkpoints(candidates, checkpoint),
+                                 query, screening, timer)
+
+    def batch_matches(self, mols: Sequence[str], screening: bool = True
+                      ) -> List[List[Tuple[int, str]]]:
+        queries = [parse_query(mol) for mol in mols]
+        timer = SearchTimer()
+        timer.resume()
+        return match_batch(self.candidates(queries, screening, timer=timer),
+                           queries, screening, timer)
+
+
+# the library of this process
+if SEARCH_LIBRARY == "scan":
+    library = TableScan()
+elif SEARCH_LIBRARY == "mmap":
+    library = MappedLibrary()
+else:
+    library = MoleculeLibrary()
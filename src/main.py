@@ -1,17 +1,55 @@
 # from typing import List, Generator  # , Union, Optional
+import json
+from asyncio import ensure_future, wait
+from contextlib import asynccontextmanager
+from itertools import islice
+from threading import Event
+from typing import AsyncGenerator, Iterator, List, Tuple
+import anyio
 from rdkit.Chem import MolFromSmiles  # , Draw
-from fastapi import FastAPI, status, HTTPException, UploadFile
+from fastapi import (FastAPI, status, HTTPException, UploadFile, Request,
+                     Depends)
+from fastapi.responses import (JSONResponse, PlainTextResponse, Response,
+                               StreamingResponse)
+from prometheus_client import CONTENT_TYPE_LATEST
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
 from pydantic import BaseModel
 from sqlalchemy.exc import IntegrityError, NoResultFound  # , SQLAlchemyError
+from redis.exceptions import RedisError
+from kombu.exceptions import OperationalError
 from os import getenv
-from src.dao import MoleculeDAO
+from src.dao import MoleculeDAO, AsyncMoleculeDAO, async_engine
+from src.dao import UnitOfWork, current_work
+from src.chemistry import molecule_hash, parse_query, run_rdkit, smarts_query
 from src.logger import logger
+from src.metrics import latest
+from src.profiling import (allowed, current_profile, get_profile,
+                           profile_names, profile_text, request_token)
 from src.middleware import log_middleware
-from src.caching import redis_client, get_cached_result, set_cache
-from src.tasks import substructure_search_task, substructure_search
+from src.caching import (redis_client, get_cached_result, cache_search,
+                         search_key, search_task_key, get_search_task,
+                         aget_cached_result,
+                         aget_cached_results,
+                         astart_search_task, async_redis_client, get_hits,
+                         cancel_search_task,
+                         async_cache_client,
+                         finish_search_task, CACHED_QUERIES)
+from src.tasks import substructure_search_task, distributed_search_task
+from src.tasks import SEARCH_TIME_BUDGET
+from src.tasks import maintain_cache_task, batch_search_task
+from src.tasks import similarity_search_task, update_store_task
+from src.tasks import prune_changes_task
+from src.tasks import substructure_search  # noqa: F401
+from src.library import SEARCH_LIBRARY, event_checkpoint, library
+from src.importer import import_molecules, read_lines
+from src.parallel import SEARCH_WORKERS, sharded_search
+from src.similarity import similarity_index
+from src.singleflight import SingleFlight
 from src.celery_worker import celery
+from celery.exceptions import TimeoutError as TaskTimeoutError
 from celery.result import AsyncResult
+from uuid import uuid4
 
 
 class Molecule(BaseModel):
@@ -19,7 +57,93 @@ class Molecule(BaseModel):
     smiles: str
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ Load the molecule library once for this web process """
+    if SEARCH_WORKERS > 1:
+        sharded_search.start()
+    else:
+        library.load()
+    yield
+    sharded_search.close()
+    await async_redis_client.aclose()
+    await async_cache_client.aclose()
+    if async_engine is not None:
+        await async_engine.dispose()
+
+
+def maintain_cached_searches() -> None:
+    """ Update the cached search results and the library store
+    with the written molecules, and prune the change log """
+    try:
+        if SEARCH_LIBRARY == "mmap":
+            update_store_task.delay()
+        if redis_client.exists(CACHED_QUERIES):
+            maintain_cache_task.delay()
+        prune_changes_task.delay()
+    except (RedisError, OperationalError) as e:
+        # the results of the next version are searched again instead
+        logger.warning(f"Cached search results are not maintained: {e}")
+
+
+# complete searches in flight in this process by cache keys
+searches = SingleFlight()
+# seconds a search request waits for the same search task in flight,
+# it answers with the task when the task takes longer
+SEARCH_TASK_WAIT = float(getenv("SEARCH_TASK_WAIT", "10"))
+# seconds between the checks of a client waiting for the next streamed hit
+DISCONNECT_POLL = 0.5
+
+
+class SearchInFlight(Exception):
+    """ The complete search is run by the task *`task_id`* longer
+    than a request waits for it """
+
+    def __init__(self, task_id: str) -> None:
+        super().__init__(task_id)
+        self.task_id = task_id
+
+
+def complete_search(mol: str, version: int,
+                    screening: bool = True) -> List[Tuple[int, str]]:
+    """
+    Find all hits of substructure *`mol`* as pairs of id and SMILES
+    and cache them at *`version`*.
+
+    A search task in flight for them is waited for instead, at most
+    `SEARCH_TASK_WAIT` seconds before raising `SearchInFlight`.
+    """
+    cache_key = search_key(mol, version)
+    if (task_id := get_search_task(cache_key)) is not None:
+        try:
+            AsyncResult(task_id, app=celery).get(timeout=SEARCH_TASK_WAIT,
+                                                 propagate=False)
+        except TaskTimeoutError:
+            raise SearchInFlight(task_id)
+        # the result of the task, the request is counted as a miss
+        if (cached := get_cached_result(cache_key,
+                                        counted=False)) is not None:
+            return MoleculeDAO.hits(cached["ids"])
+    if SEARCH_WORKERS > 1:
+        hits = sharded_search.matches(mol, screening)
+    else:
+        hits = list(library.matches(mol, screening))
+    cache_search(mol, version, hits)
+    return hits
+
+
+async def unit_of_work() -> AsyncGenerator[None, None]:
+    """ Run the DAO calls of a request on one connection """
+    work = UnitOfWork()
+    current_work.set(work)
+    try:
+        yield
+    finally:
+        # returning the connection to the pool rolls it back
+        await run_in_threadpool(work.close)
+
+
+app = FastAPI(lifespan=lifespan, dependencies=[Depends(unit_of_work)])
 app.add_middleware(BaseHTTPMiddleware, dispatch=log_middleware)
 logger.info("Started uvicorn web container " + getenv("SERVER_ID", "1"))
 
@@ -34,30 +158,131 @@ def get_server():
     return {"server_id": getenv("SERVER_ID", "1")}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """ Prometheus metrics of this web process """
+    return Response(latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def profiling_client(request: Request) -> None:
+    """ Let only the clients with a `PROFILE_TOKENS` token
+    read the profiles """
+    if not allowed(request_token(request)):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Profiling is not allowed for this client"
+            )
+
+
+@app.get("/profiles/", tags=['Profiling'],
+         dependencies=[Depends(profiling_client)])
+def retrieve_profiles():
+    """
+    Names of the saved profiles
+
+    A request sent with an allowed token in the `X-Profile-Token`
+    header or the `profile_token` query parameter is profiled,
+    the name of its profile is in the `X-Profile-Id` response header.
+    The search task it starts is profiled as `<name>-task`.
+    """
+    return profile_names()
+
+
+@app.get("/profiles/{name}", tags=['Profiling'],
+         dependencies=[Depends(profiling_client)])
+def retrieve_profile(name: str, text: bool = False, limit: int = 50):
+    """
+    Get the saved profile **name** as a `pstats` file, or with **text**
+    the **limit** functions taking the most cumulative time
+    """
+    if (data := get_profile(name)) is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"The profile {name} is not found."
+            )
+    if text:
+        return PlainTextResponse(profile_text(data, limit))
+    return Response(data, media_type="application/octet-stream",
+                    headers={"Content-Disposition":
+                             f'attachment; filename="{name}.pstats"'})
+
+
+def hits_page(data: dict, offset: int, limit: int) -> dict:
+    """ Get the page of a search task result from *`offset`*
+    with the SMILES strings of at most *`limit`* stored hits """
+    if "hits" not in data:
+        return data
+    ids = get_hits(data["hits"], offset, limit)
+    page = {key: value for key, value in data.items() if key != "hits"}
+    return {**page, "offset": offset, "limit": limit,
+            "result": [smiles for _, smiles in MoleculeDAO.hits(ids)]}
+
+
 @app.get("/tasks/{task_id}", tags=['Substructure search'])
-async def get_task_result(task_id: str):
+def get_task_result(task_id: str, offset: int = 0, limit: int = 100):
+    """
+    Check the status of a task and get its result when it is completed.
+
+    The hits of a search are stored apart from the task result, its
+    `count` tells how many there are. Get the page of at most
+    **limit** of them beginning from **offset**, so every poll is
+    as cheap as the page whatever the number of hits.
+
+    A running search reports its `progress`, a search cancelled
+    or out of its time budget is `complete: false` with the hits
+    found before it stopped.
+    """
     task_result = AsyncResult(task_id, app=celery)
     task = {"task_id": task_id, "status": task_result.state}
     if task_result.state == 'STARTED':
         task["status"] = "Task is still processing"
+    elif task_result.state == 'PROGRESS':
+        task["status"] = "Task is still processing"
+        # a search reports the molecules checked and its hits so far
+        task["progress"] = task_result.info
+        if "chunks" in task_result.info:
+            # a distributed search reports the ids of its chunk subtasks
+            chunks = [AsyncResult(chunk_id, app=celery)
+                      for chunk_id in task_result.info["chunks"]]
+            task["progress"] = {"chunks": len(chunks),
+                                "completed": sum(c.ready() for c in chunks)}
     elif task_result.successful() or task_result.state == 'SUCCESS':
         task["status"] = "Task completed"
-        task["result"] = task_result.result
+        result = task_result.result
+        if isinstance(result, dict) and "data" in result:
+            data = result["data"]
+            result = {**result, "data": (
+                [hits_page(query, offset, limit) for query in data]
+                if isinstance(data, list)
+                else hits_page(data, offset, limit))}
+        task["result"] = result
     return task
 
 
+@app.delete("/tasks/{task_id}", tags=['Substructure search'])
+def cancel_task(task_id: str):
+    """
+    Cancel a task, a queued one does not start and a running
+    substructure search stops at its next checkpoint, its result
+    is the hits found so far
+    """
+    cancel_search_task(task_id)
+    celery.control.revoke(task_id)
+    return {"task_id": task_id, "status": "Cancelling"}
+
+
 @app.get("/smiles/", tags=['Checking stored molecule SMILES'])
-def retrieve_all_molecules(limit: int = 100, offset: int = 0):
+async def retrieve_all_molecules(limit: int = 100, offset: int = 0):
     '''
     Beginning from *offset, limit* the number of molecules in the response.
     '''
-    return MoleculeDAO.all(limit, offset)
+    return await AsyncMoleculeDAO.all(limit, offset)
 
 
 @app.post("/smiles/", status_code=status.HTTP_201_CREATED,
           tags=['Storing molecule SMILES'])
 def add_molecule_smiles(smiles: str):
-    if MolFromSmiles(smiles) is None:
+    if (mol := MolFromSmiles(smiles)) is None:
         raise HTTPException(
             status_code=400,
             detail=("SMILES Parse Error: syntax error "
@@ -65,7 +290,8 @@ def add_molecule_smiles(smiles: str):
                     )
     else:
         try:
-            MoleculeDAO.create(smiles=smiles)
+            # the unique index finds the molecule stored already
+            instance = MoleculeDAO.create(smiles=smiles, mol=mol)
         except IntegrityError as e:
             print(e)
             raise HTTPException(
@@ -78,13 +304,34 @@ def add_molecule_smiles(smiles: str):
             #             "an IntegrityError: UNIQUE constraint failed")
             #             )
         else:
-            return MoleculeDAO.last(smiles=smiles)
+            maintain_cached_searches()
+            return instance
+
+
+@app.get("/smiles/exact/", tags=['Checking stored molecule SMILES'])
+async def retrieve_molecule_by_smiles(smiles: str):
+    """
+    Get the stored molecule with the same canonical SMILES as *smiles*,
+    whichever way it is written.
+    """
+    if (hash := await run_rdkit(molecule_hash, smiles)) is None:
+        raise HTTPException(
+            status_code=400,
+            detail=("SMILES Parse Error: syntax error "
+                    f"for input '{smiles}'.")
+                    )
+    if (instance := await AsyncMoleculeDAO.find(hash)) is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"The molecule {smiles} is not found."
+            )
+    return instance
 
 
 @app.get("/smiles/{identifier}", tags=['Checking stored molecule SMILES'])
-def retrieve_molecule_by_id(identifier: int):
+async def retrieve_molecule_by_id(identifier: int):
     try:
-        instance = MoleculeDAO.get(id=identifier)
+        instance = await AsyncMoleculeDAO.get(id=identifier)
     except NoResultFound as e:
         print(e)
         raise HTTPException(
@@ -103,20 +350,30 @@ def create_update_molecule(identifier: int, updated: Molecule):
             detail=("The molecule identifiers do not match. "
                     f"{identifier} != {updated.identifier}")
                 )
-    if MolFromSmiles(updated.smiles) is None:
+    if (mol := MolFromSmiles(updated.smiles)) is None:
         raise HTTPException(
             status_code=400,
             detail=("SMILES Parse Error: syntax error "
                     f"for input: {updated.smiles}")
                 )
     try:
-        MoleculeDAO.update(id=identifier, smiles=updated.smiles)
-    except NoResultFound as e:
+        try:
+            instance = MoleculeDAO.update(id=identifier,
+                                          smiles=updated.smiles, mol=mol)
+        except NoResultFound as e:
+            print(e)
+            instance = MoleculeDAO.create(id=identifier,
+                                          smiles=updated.smiles, mol=mol)
+            # TODO: 201 Created
+    except IntegrityError as e:
+        # the unique index finds the molecule stored as another id
         print(e)
-        MoleculeDAO.create(id=identifier, smiles=updated.smiles)
-        # TODO: 201 Created
-    finally:
-        return MoleculeDAO.get(id=identifier)
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Molecule with this SMILES value already exists"
+            )
+    maintain_cached_searches()
+    return instance
 
 
 @app.delete("/smiles/{identifier}", tags=['Storing molecule SMILES'],
@@ -133,13 +390,73 @@ def delete_molecule(identifier: int):
                     f"{identifier} is not found.")
             )
     else:
+        maintain_cached_searches()
         return instance
 
 
+async def stream_hits(request: Request, hits: Iterator[Tuple[int, str]],
+                      stop: int | None, offset: int = 0,
+                      cache_version: int | None = None,
+                      query: str | None = None,
+                      stopped: Event | None = None
+                      ) -> AsyncGenerator[str, None]:
+    """
+    Write every chemical compound from *`hits`* of ids and SMILES
+    strings after the first *`offset`* as an NDJSON line as soon as
+    it is found.
+
+    The search stops after *`stop`* hits or when the client disconnects,
+    checked every `DISCONNECT_POLL` seconds while waiting for a hit.
+    Then *`stopped`* is set for the checkpoints of the search to stop
+    it, and *`hits`* is closed once the search thread has left it.
+    The complete search result of *`query`*, the searched SMILES string
+    by default, is cached at *`cache_version`* if given.
+    """
+    found = []
+    pending = None
+    try:
+        while stop is None or len(found) < stop:
+            if await request.is_disconnected():
+                logger.debug(f"Client disconnected after {len(found)} hits")
+                return
+            # the search runs in a thread so the event loop is not blocked
+            pending = ensure_future(run_rdkit(next, hits, None))
+            while not (await wait({pending}, timeout=DISCONNECT_POLL))[0]:
+                if await request.is_disconnected():
+                    logger.debug(f"Client disconnected after {len(found)} "
+                                 f"hits, stopping the search")
+                    return
+            compound, pending = pending.result(), None
+            if compound is None:
+                break
+            found.append(compound)
+            if len(found) > offset:
+                yield json.dumps({"smiles": compound[1]}) + "\n"
+        else:
+            # the search is stopped before the end
+            return
+    finally:
+        if stopped is not None:
+            stopped.set()
+        # also when the response is cancelled, the generator running
+        # in the search thread cannot be closed
+        with anyio.CancelScope(shield=True):
+            if pending is not None:
+                await wait({pending})
+                # stopped by its checkpoint, or failed
+                pending.exception()
+            if hasattr(hits, "close"):
+                hits.close()
+    if cache_version is not None:
+        await run_rdkit(cache_search, query or request.path_params["mol"],
+                        cache_version, found)
+
+
 @app.get("/search/{mol}", tags=['Substructure search'])
-def search_molecules(mol: str = None, max_num: int = 0,
+def search_molecules(request: Request, mol: str = None, max_num: int = 0,
                      limit: int = 100, offset: int = 0,
-                     no_cache: bool = False):
+                     no_cache: bool = False, screening: bool = True,
+                     stream: bool = False, smarts: bool = False):
     """
     Substructure search for all added molecules
 
@@ -148,44 +465,145 @@ def search_molecules(mol: str = None, max_num: int = 0,
     substructure `mol` as SMILES strings
     - get the first **max_num** chemical compounds
     that contain substructure `mol`
+    - beginning from **offset**, **limit** the number of
+    found chemical compounds in the response
     - specifying **no_cache** in any other case variation
     as True, true, on, yes, 1 will delete the cache
+    - set **screening** to false to skip the fingerprint screen
+    and match every molecule
+    - with `SEARCH_WORKERS` processes configured the search runs
+    on all of them over the whole library
+    - with **stream** the found chemical compounds are sent as
+    `application/x-ndjson` lines as soon as they are found,
+    the search stops when the client disconnects. The search in
+    `SEARCH_WORKERS` processes is not streamed, its first
+    **offset** + **limit** hits are found before they are sent
+    - with **smarts** `mol` is a SMARTS pattern with query features
+    like atom lists, ring membership and recursive SMARTS
+    - while a search task for `mol` runs longer than `SEARCH_TASK_WAIT`
+    seconds the response is `202 Accepted` with its **task_id**
+    and the link to read its result
     """
-    cache_key = f"search:{mol}"
+    query = smarts_query(mol) if smarts and mol is not None else mol
+    # read before searching, so the result has every write of the key
+    version = MoleculeDAO.version()
+    cache_key = search_key(query, version)
     if no_cache:
-        redis_client.delete("SMILES", cache_key)
-    if redis_client.exists("SMILES"):
-        molecules = get_cached_result("SMILES")
-        logger.debug("get_cached SMILES")
-    else:
-        molecules = MoleculeDAO.smiles(limit, offset)
-        set_cache("SMILES", molecules, 5*60)
-        logger.debug("set_cache SMILES")
-    if len(molecules) < 1 or mol is None:
+        redis_client.delete(cache_key)
+    sharded = SEARCH_WORKERS > 1
+    if not sharded:
+        library.refresh()
+    if mol is None or (not sharded and len(library) < 1):
         raise HTTPException(
             status_code=400,
             detail="The molecules for substructure search aren't provided"
             )
-    if redis_client.exists(cache_key):
-        return {"source": "cache", "data": get_cached_result(cache_key)}
-    if max_num <= 0:
-        chemical_compounds = list(substructure_search(molecules, mol))
+    if stream:
+        stop = offset + limit
+        if max_num > 0:
+            stop = min(stop, max_num)
+        # set when the client disconnects, to stop the search
+        stopped = Event()
+        if (cached := get_cached_result(cache_key)) is not None:
+            hits = iter(MoleculeDAO.hits(cached["ids"][:stop]))
+            version = None
+        elif sharded:
+            # the search processes send their hits when they are done,
+            # each of them finds only the first `stop` ones
+            hits = iter(sharded_search.matches(query, screening, stop)
+                        if stop > 0 else [])
+        else:
+            hits = library.matches(query, screening,
+                                   checkpoint=event_checkpoint(stopped))
+        return StreamingResponse(
+            stream_hits(request, hits, stop, offset, version, query,
+                        stopped),
+            media_type="application/x-ndjson")
+    if (cached := get_cached_result(cache_key)) is not None:
+        source = "cache"
+        ids = cached["ids"][:max_num] if max_num > 0 else cached["ids"]
+        # only the SMILES strings of the sent molecules are read
+        hits = MoleculeDAO.hits(ids[offset:offset + limit])
+        chemical_compounds = [smiles for _, smiles in hits]
     else:
-        num = 0
-        chemical_compounds = []
-        for compound in substructure_search(molecules, mol):
-            chemical_compounds.append(compound)
-            num += 1
-            if num == max_num:
-                break
+        source = "database"
+        if max_num <= 0:
+            # only the complete search result is cached, the same
+            # searches at the same time wait for one of them
+            try:
+                hits = searches.run(cache_key, complete_search,
+                                    query, version, screening)
+            except SearchInFlight as e:
+                # its result is read from the task
+                link = getenv("DOMAIN", "http://localhost")
+                link += app.url_path_for("get_task_result",
+                                         task_id=e.task_id)
+                task_status = AsyncResult(e.task_id, app=celery).status
+                return JSONResponse({"task_id": e.task_id,
+                                     "status": task_status, "link": link},
+                                    status_code=status.HTTP_202_ACCEPTED)
+        elif sharded:
+            hits = sharded_search.matches(query, screening, max_num)
+        else:
+            hits = list(islice(library.matches(query, screening), max_num))
+        chemical_compounds = [smiles for _, smiles
+                              in hits[offset:offset + limit]]
     search_result = {"query": mol, "result": chemical_compounds}
-    set_cache(cache_key, search_result)
-    # sets an expiration of 60s
-    return {"source": "database", "data": search_result}
+    return {"source": source, "data": search_result}
+
+
+@app.post("/search/batch/", tags=['Substructure search'])
+async def create_batch_task(queries: List[str], screening: bool = True,
+                            smarts: bool = False):
+    """
+    Substructure search for many **queries** as SMILES strings
+    in one pass over the stored molecules, every molecule is loaded
+    once and matched against all queries.
+
+    - If the results of all queries are cached, return them immediately
+    as a list of `query` and `result` in the order of **queries**.
+    - Otherwise send a `batch search task` to **Celery** and check
+    its status and results by `/tasks/{task_id}`.
+    - With **smarts** the **queries** are SMARTS patterns.
+    """
+    if not queries:
+        raise HTTPException(status_code=400,
+                            detail="At least one query is required.")
+    searched = ([smarts_query(query) for query in queries] if smarts
+                else queries)
+    mols = await run_rdkit(lambda: [parse_query(query)
+                                    for query in searched])
+    invalid = [query for query, mol in zip(queries, mols) if mol is None]
+    if invalid:
+        raise HTTPException(
+            status_code=400,
+            detail=("SMILES Parse Error: syntax error "
+                    f"for input {invalid}.")
+                    )
+    version = await AsyncMoleculeDAO.version()
+    keys = await run_rdkit(lambda: [search_key(query, version)
+                                    for query in searched])
+    results = await aget_cached_results(keys)
+    if None in results:
+        task = await run_in_threadpool(
+            batch_search_task.apply_async, (searched, screening),
+            {"version": version})
+        link = getenv("DOMAIN", "http://localhost")
+        link += app.url_path_for("get_task_result", task_id=task.id)
+        return {"task_id": task.id, "status": "PENDING", "link": link}
+    ids = sorted({id for result in results for id in result["ids"]})
+    smiles = dict(await AsyncMoleculeDAO.hits(ids))
+    return {"source": "cache search",
+            "data": [{"query": query,
+                      "result": [smiles[id] for id in result["ids"]
+                                 if id in smiles]}
+                     for query, result in zip(queries, results)]}
 
 
 @app.post("/search/{smiles}", tags=['Substructure search'])
-async def create_task(smiles: str):
+async def create_task(smiles: str, distributed: bool = False,
+                      time_budget: float = SEARCH_TIME_BUDGET,
+                      smarts: bool = False):
     """
     ### Modify the substructure search functionality to use Celery.
     Send a POST request to add a search task
@@ -199,21 +617,113 @@ async def create_task(smiles: str):
         To check the status of the task `/tasks/{task_id}`.
         2. It performs the search, caches the result,
         3. and then you can send request to get results by task url.
+    - With **distributed** the search is split into chunks of molecule
+    ids searched by all **Celery** workers, the task status reports
+    how many of them are completed.
+    - The search stops after **time_budget** seconds with the hits
+    found so far, not cached and marked as incomplete. The same
+    searches with the same budget at the same time share a task.
+    - With **smarts** `smiles` is a SMARTS pattern.
     """
-    if MolFromSmiles(smiles) is None:
+    if smarts:
+        smiles = smarts_query(smiles)
+    if await run_rdkit(parse_query, smiles) is None:
         raise HTTPException(
             status_code=400,
             detail=("SMILES Parse Error: syntax error "
                     f"for input '{smiles}'.")
                     )
-    cache_key = f"search:{smiles}"
-    result = get_cached_result(cache_key)
+    version = await AsyncMoleculeDAO.version()
+    cache_key = await run_rdkit(search_key, smiles, version)
+    result = await aget_cached_result(cache_key)
     if result is None:
-        task = substructure_search_task.delay(smiles)
+        # the same searches share the task in flight, a complete one
+        # is not answered by a budgeted task
+        task_key = await run_rdkit(search_task_key, smiles, version,
+                                   0 if distributed else time_budget)
+        new_id = str(uuid4())
+        task_id = await astart_search_task(task_key, new_id)
+        if task_id == new_id:
+            if distributed:
+                search, options = distributed_search_task, {}
+            else:
+                search = substructure_search_task
+                options = {"time_budget": time_budget}
+                if (profile := current_profile.get()) is not None:
+                    options["profile"] = profile
+            # Celery sends and reads tasks only blocking
+            try:
+                task = await run_in_threadpool(
+                    search.apply_async, (smiles,),
+                    {"version": version, **options}, task_id=task_id)
+            except Exception:
+                # the same searches do not wait for a task never sent
+                await run_in_threadpool(finish_search_task, task_key)
+                raise
+        else:
+            task = AsyncResult(task_id, app=celery)
+        task_status = await run_in_threadpool(getattr, task, "status")
         link = getenv("DOMAIN", "http://localhost")
         link += app.url_path_for("get_task_result", task_id=task.id)
-        return {"task_id": task.id, "status": task.status, "link": link}
-    return {"source": "cache search", "data": result}
+        return {"task_id": task.id, "status": task_status, "link": link}
+    hits = await AsyncMoleculeDAO.hits(result["ids"])
+    return {"source": "cache search",
+            "data": {"query": smiles,
+                     "result": [found for _, found in hits]}}
+
+
+@app.get("/similarity/{mol}", tags=['Similarity search'])
+def search_similar_molecules(mol: str, k: int = 10, threshold: float = 0.0):
+    """
+    Similarity search for all added molecules
+
+    - **mol**: a SMILES string of the molecule to compare with
+    - **return** the **k** stored molecules most similar to `mol`
+    by Tanimoto similarity of their Morgan fingerprints, the most
+    similar first, all of them if **k** is 0
+    - only the molecules with similarity of at least **threshold**
+    """
+    if MolFromSmiles(mol) is None:
+        raise HTTPException(
+            status_code=400,
+            detail=("SMILES Parse Error: syntax error "
+                    f"for input '{mol}'.")
+                    )
+    if k < 0 or not 0 <= threshold <= 1:
+        raise HTTPException(
+            status_code=400,
+            detail="k must not be negative, threshold must be from 0 to 1"
+            )
+    similarity_index.refresh()
+    hits = similarity_index.search(mol, k, threshold)
+    return {"query": mol,
+            "result": [{"id": id, "smiles": smiles, "similarity": similarity}
+                       for id, smiles, similarity in hits]}
+
+
+@app.post("/similarity/{smiles}", tags=['Similarity search'])
+async def create_similarity_task(smiles: str, k: int = 10,
+                                 threshold: float = 0.0):
+    """
+    Send a `similarity search task` to **Celery**, check its status
+    and results by `/tasks/{task_id}`
+    """
+    if await run_rdkit(MolFromSmiles, smiles) is None:
+        raise HTTPException(
+            status_code=400,
+            detail=("SMILES Parse Error: syntax error "
+                    f"for input '{smiles}'.")
+                    )
+    if k < 0 or not 0 <= threshold <= 1:
+        raise HTTPException(
+            status_code=400,
+            detail="k must not be negative, threshold must be from 0 to 1"
+            )
+    task = await run_in_threadpool(similarity_search_task.delay,
+                                   smiles, k, threshold)
+    link = getenv("DOMAIN", "http://localhost")
+    link += app.url_path_for("get_task_result", task_id=task.id)
+    return {"task_id": task.id, "status": "PENDING", "link": link}
 
 
 @app.post("/molecules/", status_code=status.HTTP_201_CREATED,
@@ -225,6 +735,12 @@ async def upload_molecules(file: UploadFile | None = None):
     *[Optional]*
     ---
     Upload a text `file` with molecules as SMILES strings on separate lines.
+
+    The file is read in chunks, SMILES strings are parsed in the import
+    processes and stored in batches skipping invalid SMILES strings and
+    molecules stored already.
+    - **return** the numbers of `inserted`, `duplicates`
+    and `invalid` molecules
     """
     # Upload `n` molecules and add smiles to container
     # starting from identifier `start`
@@ -233,20 +749,16 @@ async def upload_molecules(file: UploadFile | None = None):
                   "CC(=O)O", "CC(=O)Oc1ccccc1C(=O)O"]
     elif (file.filename.endswith(('.txt')) and
           file.content_type == 'text/plain'):
-        upload = await file.read()
-        upload = upload.decode('utf-8').replace('\r', '').split('\n')
+        upload = read_lines(file)
     else:
         raise HTTPException(
             status_code=400,
             detail="Upload a text file with molecules as SMILES strings."
             )
-    smiles = []
-    for s in upload:
-        s = s.strip()
-        if s and s not in smiles and MolFromSmiles(s) is not None:
-            smiles.append(s)
-    MoleculeDAO.insert(*smiles)
-    return MoleculeDAO.last(limit=len(smiles))
+    summary = await import_molecules(upload)
+    if summary["inserted"]:
+        await run_in_threadpool(maintain_cached_searches)
+    return summary
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+"""
+Prometheus metrics of the web processes and the Celery workers.
+
+The web app serves them at `/metrics`, a worker from a HTTP server
+on `METRICS_PORT`. The cache hit ratio is
+`rate(search_cache_requests_total{result="hit"}[5m])
+/ rate(search_cache_requests_total[5m])` and the molecules scanned
+per second `rate(search_molecules_scanned_total[5m])`.
+
+The processes of a prefork worker share their metrics through
+the files of `PROMETHEUS_MULTIPROC_DIR` if it is set, the worker
+removes the files of its earlier runs when it starts.
+"""
+from os import getenv, getpid, listdir, makedirs, remove, path
+from time import perf_counter
+from typing import Dict
+import redis
+from redis.exceptions import RedisError
+from celery.signals import (task_postrun, task_prerun, worker_init,
+                            worker_process_shutdown, worker_ready)
+from prometheus_client import (CollectorRegistry, Counter, Histogram,
+                               REGISTRY, generate_latest, multiprocess,
+                               start_http_server)
+from prometheus_client.context_managers import Timer
+from prometheus_client.core import GaugeMetricFamily
+from src.celery_worker import celery
+from src.logger import logger
+
+# port of the metrics server of a Celery worker
+METRICS_PORT = int(getenv("METRICS_PORT", "9100"))
+MULTIPROC_DIR = getenv("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROC_DIR:
+    # the files of the metrics are written from their definition on
+    makedirs(MULTIPROC_DIR, exist_ok=True)
+
+# seconds from a cached page to a search of the whole library
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time to answer a request",
+    ["method", "route", "status"], buckets=DURATION_BUCKETS)
+STAGE_SECONDS = Histogram(
+    "search_stage_duration_seconds", "Time spent in a search stage",
+    ["stage"], buckets=DURATION_BUCKETS)
+CACHE_REQUESTS = Counter(
+    "search_cache_requests", "Search results looked up in the cache",
+    ["result"])
+MOLECULES_SCANNED = Counter(
+    "search_molecules_scanned", "Molecules screened or matched by searches")
+SCAN_RATE = Histogram(
+    "search_scan_rate_molecules_per_second",
+    "Molecules scanned per second by a search",
+    buckets=(1e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7))
+TASK_SECONDS = Histogram(
+    "celery_task_duration_seconds", "Time to run a Celery task",
+    ["task", "state"], buckets=DURATION_BUCKETS)
+
+
+def stage(name: str) -> Timer:
+    """ Time a search stage, as a context manager or decorator """
+    return STAGE_SECONDS.labels(name).time()
+
+
+def cache_lookup(hit: bool) -> None:
+    CACHE_REQUESTS.labels("hit" if hit else "miss").inc()
+
+
+class SearchTimer:
+    """
+    Time of one substructure search split into its screening and
+    matching stages, observed once when the search ends.
+
+    The search is timed only while it runs, not while its hits are
+    used. The time not spent matching is screening: reading the
+    molecules and comparing their fingerprints with the query.
+    """
+
+    def __init__(self) -> None:
+        self.scanned = 0
+        self.matching = 0.0
+        self.elapsed = 0.0
+        self.started: float | None = None
+
+    def resume(self) -> None:
+        if self.started is None:
+            self.started = perf_counter()
+
+    def pause(self) -> None:
+        if self.started is not None:
+            self.elapsed += perf_counter() - self.started
+            self.started = None
+
+    def observe(self) -> None:
+        """ Record the search, it may be stopped before the end """
+        self.pause()
+        STAGE_SECONDS.labels("screening").observe(
+            max(self.elapsed - self.matching, 0.0))
+        STAGE_SECONDS.labels("matching").observe(self.matching)
+        MOLECULES_SCANNED.inc(self.scanned)
+        if self.scanned and self.elapsed > 0:
+            SCAN_RATE.observe(self.scanned / self.elapsed)
+
+
+class QueueDepthCollector:
+    """ Number of tasks waiting in the Celery queues of the broker,
+    read when the metrics are collected """
+
+    def __init__(self) -> None:
+        self.client = redis.Redis.from_url(celery.conf.broker_url,
+                                           socket_connect_timeout=1)
+
+    @staticmethod
+    def describe():
+        yield GaugeMetricFamily("celery_queue_depth",
+                                "Tasks waiting in a Celery queue",
+                                labels=["queue"])
+
+    def collect(self):
+        queues = {celery.conf.task_default_queue}
+        queues.update(queue.name for queue in celery.conf.task_queues or ())
+        depth = next(self.describe())
+        try:
+            for queue in sorted(queues):
+                depth.add_metric([queue], self.client.llen(queue))
+        except RedisError as e:
+            logger.warning(f"Celery queue depth is not read: {e}")
+            return
+        yield depth
+
+
+queue_depth = QueueDepthCollector()
+
+
+def registry() -> CollectorRegistry:
+    """ The metrics of this process, or of all processes writing
+    to `PROMETHEUS_MULTIPROC_DIR` """
+    if not MULTIPROC_DIR:
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    collected.register(queue_depth)
+    return collected
+
+
+def latest() -> bytes:
+    """ The metrics in the Prometheus text format """
+    return generate_latest(registry())
+
+
+if not MULTIPROC_DIR:
+    REGISTRY.register(queue_depth)
+
+# start times of the tasks running in this process by task ids
+task_starts: Dict[str, float] = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id: str, **kwargs) -> None:
+    task_starts[task_id] = perf_counter()
+
+
+@task_postrun.connect
+def observe_task(task_id: str, task, state: str | None = None,
+                 **kwargs) -> None:
+    if (start := task_starts.pop(task_id, None)) is not None:
+        TASK_SECONDS.labels(task.name, state or "UNKNOWN").observe(
+            perf_counter() - start)
+
+
+@worker_init.connect
+def clear_metrics(**kwargs) -> None:
+    """ Remove the metrics files of an earlier run of the worker,
+    before its pool processes start writing theirs """
+    if not MULTIPROC_DIR:
+        return
+    # the files of this process are written from the definitions on
+    own = f"_{getpid()}.db"
+    for name in listdir(MULTIPROC_DIR):
+        if name.endswith(".db") and not name.endswith(own):
+            remove(path.join(MULTIPROC_DIR, name))
+    logger.debug(f"Cleared the metrics of {MULTIPROC_DIR}")
+
+
+@worker_ready.connect
+def start_metrics_server(**kwargs) -> None:
+    """ Export the metrics of a worker and its pool processes """
+    start_http_server(METRICS_PORT, registry=registry())
+    logger.info(f"Serving worker metrics on port {METRICS_PORT}")
+
+
+@worker_process_shutdown.connect
+def forget_process(**kwargs) -> None:
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(getpid())
@@ -1,6 +1,8 @@
 from starlette.requests import Request
 import time
 from src.logger import logger
+from src.metrics import REQUEST_SECONDS
+from src.profiling import PROFILE_PARAM, profile_call, requested_profile
 
 
 # @app.middleware("http")
@@ -8,19 +10,39 @@ async def log_middleware(request: Request, call_next):
     log_extra =  {
         'method': request.method,
         'url': request.url.path,
-        'query': dict(request.query_params),
+        # the profiling token is not logged
+        'query': {key: value for key, value in request.query_params.items()
+                  if key != PROFILE_PARAM},
     }
     if not log_extra['query']:
         del log_extra['query']
-    start_time = time.time()
+    start_time = time.perf_counter()
+    profile = requested_profile(request)
     try:
-        response = await call_next(request)
+        if profile is None:
+            response = await call_next(request)
+        else:
+            response, profiled = await profile_call(profile, call_next,
+                                                    request)
+            if profiled:
+                response.headers['X-Profile-Id'] = profile
     except Exception as e:
+        observe_request(request, 500, time.perf_counter() - start_time)
         logger.error(log_extra, extra=log_extra)
         logger.exception(e)
         raise
     else:
-        process_time = round(time.time() - start_time, 2)
-        log_extra['process_time'] = process_time
+        process_time = time.perf_counter() - start_time
+        observe_request(request, response.status_code, process_time)
+        log_extra['process_time'] = round(process_time, 4)
         logger.info(log_extra, extra=log_extra)
-    return response
\ No newline at end of file
+    return response
+
+
+def observe_request(request: Request, status: int, seconds: float) -> None:
+    """ Record the latency of a request by its route template,
+    so the paths of the same route share a histogram """
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(request.method,
+                           getattr(route, "path", "unmatched"),
+                           str(status)).observe(seconds)
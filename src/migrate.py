@@ -0,0 +1,11 @@
+"""
+Create or update the database schema of the stored molecules and
+backfill their computed columns, once before the web and worker
+processes start:
+
+    python -m src.migrate
+"""
+from src.dao import migrate
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,246 @@
+from concurrent.futures import Future
+from heapq import merge
+from itertools import count, islice
+from multiprocessing import get_context
+from multiprocessing.connection import Connection
+from os import cpu_count, getenv
+from threading import Lock, Thread
+from typing import Dict, List, Tuple
+from src.logger import logger
+
+# number of search processes, the search runs in the calling process
+# when it is not more than 1. A Celery worker searching with them runs
+# one pool process, every pool process would start its own.
+SEARCH_WORKERS = int(getenv("SEARCH_WORKERS", "0"))
+
+
+def serve_shard(index: int, count: int, connection: Connection) -> None:
+    """
+    Keep the shard *`index`* of *`count`* of the molecule library
+    in this process and answer search requests in order, each sent
+    with an id and answered with it, until `None` is received.
+    """
+    from src.library import (SEARCH_LIBRARY, MappedLibrary, MoleculeLibrary,
+                             SearchStopped, task_checkpoint)
+
+    shard = (index, count)
+    library = (MappedLibrary(shard) if SEARCH_LIBRARY == "mmap"
+               else MoleculeLibrary(shard))
+    library.load()
+    connection.send(len(library))
+    while (message := connection.recv()) is not None:
+        request_id, (mol, screening, max_num, limits) = message
+        try:
+            library.refresh()
+            if isinstance(mol, list):
+                # a batch of queries
+                result = library.batch_matches(mol, screening)
+            elif limits is None:
+                hits = library.matches(mol, screening)
+                result = list(islice(hits, max_num or None))
+            else:
+                # the hits found before the search of a task stops
+                found, stopped = [], None
+                try:
+                    for hit in library.matches(
+                            mol, screening,
+                            checkpoint=task_checkpoint(*limits)):
+                        found.append(hit)
+                except SearchStopped as e:
+                    stopped = str(e)
+                result = (found, stopped)
+        except Exception as e:
+            logger.exception(e)
+            result = e
+        connection.send((request_id, result))
+
+
+class Shard:
+    """
+    A search process keeping one shard of the library. Requests are
+    sent to it by any thread, a reader thread passes the answers
+    to the futures of the requests waiting for them.
+    """
+
+    def __init__(self, index: int, count: int, context) -> None:
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=serve_shard, args=(index, count, child),
+            name=f"search-shard-{index}", daemon=True)
+        self.process.start()
+        # the connection of this process ends when the search process does
+        child.close()
+        self.pending: Dict[int, Future] = {}
+        self.alive = True
+        self.lock = Lock()
+        self.reader = Thread(target=self.read, daemon=True,
+                             name=f"{self.process.name}-reader")
+
+    def ready(self) -> int:
+        """ Wait for the shard to be loaded, returns its size """
+        size = self.connection.recv()
+        self.reader.start()
+        return size
+
+    def read(self) -> None:
+        while True:
+            try:
+                request_id, result = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                future = self.pending.pop(request_id, None)
+            if future is not None:
+                future.set_result(result)
+        self.fail(ConnectionError(f"Search process {self.process.name} "
+                                  f"stopped"))
+
+    def fail(self, error: Exception) -> None:
+        """ Fail the waiting requests, the shard is not used any more """
+        with self.lock:
+            self.alive = False
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def is_alive(self) -> bool:
+        return self.alive and self.process.is_alive()
+
+    def submit(self, request_id: int, request: tuple) -> Future:
+        """ Send *`request`* to the shard, its answer is the result
+        of the returned future """
+        future: Future = Future()
+        with self.lock:
+            if not self.alive:
+                raise ConnectionError(f"Search process {self.process.name} "
+                                      f"stopped")
+            self.pending[request_id] = future
+            try:
+                self.connection.send((request_id, request))
+            except OSError:
+                del self.pending[request_id]
+                raise
+        return future
+
+    def close(self) -> None:
+        """ Stop the search process """
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        if self.reader.is_alive():
+            self.reader.join()
+        self.connection.close()
+
+
+class ShardedSearch:
+    """
+    Substructure search over the molecule library split into shards,
+    one for each of the *`workers`* processes keeping it in memory.
+
+    The processes are started by `start` or by the first search,
+    a process that stopped is started again by the next search.
+    Searches from many threads are sent to the shards at once,
+    every shard answers them in order.
+    """
+
+    def __init__(self, workers: int | None = None) -> None:
+        self.workers = workers or cpu_count() or 1
+        self.shards: List[Shard] = []
+        # starting and restarting the processes
+        self.lock = Lock()
+        self.request_ids = count()
+
+    def start(self) -> None:
+        """ Start the search processes and wait for their shards """
+        self.running()
+
+    def running(self) -> List[Shard]:
+        """ The shards, their processes started if they are not running """
+        with self.lock:
+            stopped = [index for index in range(self.workers)
+                       if index >= len(self.shards)
+                       or not self.shards[index].is_alive()]
+            if not stopped:
+                return list(self.shards)
+            # fork would share the database connections of this process
+            context = get_context("spawn")
+            started = {index: Shard(index, self.workers, context)
+                       for index in stopped}
+            sizes = [shard.ready() for shard in started.values()]
+            for index, shard in started.items():
+                if index < len(self.shards):
+                    logger.warning(f"Restarted search process {index}")
+                    self.shards[index].close()
+                    self.shards[index] = shard
+                else:
+                    self.shards.append(shard)
+            logger.debug(f"Started {len(started)} of {self.workers} search "
+                         f"processes, shards of {sizes} molecules")
+            return list(self.shards)
+
+    def close(self) -> None:
+        """ Stop the search processes """
+        with self.lock:
+            for shard in self.shards:
+                shard.close()
+            self.shards = []
+
+    def matches(self, mol: str, screening: bool = True,
+                max_num: int = 0) -> List[Tuple[int, str]]:
+        """
+        Find molecules as pairs of id and SMILES string, ordered by id,
+        that contain substructure *`mol`* as SMILES string.
+
+        Get only the first *`max_num`* of them if it is positive,
+        every shard stops searching after finding as many.
+        """
+        shards = self.request(mol, screening, max_num, None)
+        return list(islice(merge(*shards), max_num or None))
+
+    def task_matches(self, mol: str, screening: bool = True,
+                     task_id: str | None = None,
+                     deadline: float | None = None
+                     ) -> Tuple[List[Tuple[int, str]], str | None]:
+        """
+        Find the `matches` of *`mol`* for the search task *`task_id`*,
+        every shard stops searching when the task is cancelled or past
+        the `time()` *`deadline`*, checked at its checkpoints.
+
+        Returns the hits found and why the search stopped,
+        or `None` if it is complete.
+        """
+        shards = self.request(mol, screening, 0, (task_id, deadline))
+        stopped = next((stopped for _, stopped in shards if stopped), None)
+        return list(merge(*(hits for hits, _ in shards))), stopped
+
+    def batch_matches(self, mols: List[str], screening: bool = True
+                      ) -> List[List[Tuple[int, str]]]:
+        """ Find the `matches` of every substructure of *`mols`*,
+        every shard makes one pass over its molecules """
+        shards = self.request(list(mols), screening, 0, None)
+        return [list(merge(*hits)) for hits in zip(*shards)]
+
+    def request(self, *request) -> list:
+        """ Send a search *`request`* to all shards and get their hits """
+        request_id = next(self.request_ids)
+        futures = [shard.submit(request_id, request)
+                   for shard in self.running()]
+        shards = [future.result() for future in futures]
+        for hits in shards:
+            if isinstance(hits, Exception):
+                raise hits
+        return shards
+
+    def search(self, mol: str, screening: bool = True,
+               max_num: int = 0) -> List[str]:
+        """ Find the SMILES strings of `matches` """
+        return [smiles for _, smiles in self.matches(mol, screening, max_num)]
+
+
+# the sharded search of this process, used if SEARCH_WORKERS > 1
+sharded_search = ShardedSearch(SEARCH_WORKERS)
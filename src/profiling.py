@@ -0,0 +1,138 @@
+import cProfile
+import marshal
+import pstats
+from contextlib import contextmanager
+from contextvars import ContextVar
+from hmac import compare_digest
+from io import StringIO
+from os import getenv
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Generator, List
+from uuid import uuid4
+from redis.exceptions import RedisError
+from starlette.requests import Request
+from src.caching import cache_client
+from src.logger import logger
+
+# tokens of the clients allowed to profile their requests, comma separated,
+# no request is profiled without them
+PROFILE_TOKENS = [token for token in getenv("PROFILE_TOKENS", "").split(",")
+                  if token]
+# seconds a saved profile is kept
+PROFILE_TTL = int(getenv("PROFILE_TTL", "86400"))
+# a request is profiled with an allowed token in the header or the query
+PROFILE_HEADER = "X-Profile-Token"
+PROFILE_PARAM = "profile_token"
+
+# the name of the profile of the request handled in this context
+current_profile: ContextVar[str | None] = ContextVar("current_profile",
+                                                     default=None)
+# only one profiler runs at a time in a process
+profiler_lock = Lock()
+
+
+def allowed(token: str | None) -> bool:
+    """ Check that *`token`* is one of `PROFILE_TOKENS` """
+    return token is not None and any(compare_digest(token, allowed)
+                                     for allowed in PROFILE_TOKENS)
+
+
+def request_token(request: Request) -> str | None:
+    return (request.headers.get(PROFILE_HEADER)
+            or request.query_params.get(PROFILE_PARAM))
+
+
+def requested_profile(request: Request) -> str | None:
+    """ Get a new profile name for the *`request`* of an allowed client
+    asking to be profiled, or `None` """
+    if not PROFILE_TOKENS or not allowed(request_token(request)):
+        return None
+    return uuid4().hex
+
+
+def task_profile(profile: str) -> str:
+    """ Name of the profile of the task started by the request
+    profiled as *`profile`* """
+    return f"{profile}-task"
+
+
+def profile_key(name: str) -> str:
+    return f"profile:{name}"
+
+
+@contextmanager
+def profiled(name: str) -> Generator[bool, None, None]:
+    """
+    Run the code of the context under the deterministic profiler
+    and save its statistics as the profile *`name`*, also when
+    the code fails. Yields whether the code is profiled, it is not
+    while another profile of this process is running.
+
+    Before Python 3.12 only the calling thread is profiled,
+    since 3.12 all threads of the process are.
+    """
+    if not profiler_lock.acquire(blocking=False):
+        logger.warning(f"Profile {name} is skipped, "
+                       "another profile is running")
+        yield False
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield True
+        finally:
+            profiler.disable()
+            save_profile(name, profiler)
+    finally:
+        profiler_lock.release()
+
+
+async def profile_call(name: str, call, *args):
+    """ Await *`call`* with *`args`* `profiled` as *`name`*, the tasks
+    it starts are profiled too. Returns its result and whether it
+    was profiled """
+    token = current_profile.set(name)
+    try:
+        with profiled(name) as running:
+            return await call(*args), running
+    finally:
+        current_profile.reset(token)
+
+
+def save_profile(name: str, profiler: cProfile.Profile) -> None:
+    """ Save the statistics of *`profiler`* in the format of
+    `pstats` files for `PROFILE_TTL` seconds """
+    profiler.create_stats()
+    try:
+        cache_client.setex(profile_key(name), PROFILE_TTL,
+                           marshal.dumps(profiler.stats))
+    except RedisError as e:
+        logger.warning(f"Profile {name} is not saved: {e}")
+    else:
+        logger.info(f"Saved profile {name}")
+
+
+def get_profile(name: str) -> bytes | None:
+    """ Get the saved profile *`name`* as a `pstats` file, or `None` """
+    return cache_client.get(profile_key(name))
+
+
+def profile_names() -> List[str]:
+    """ Get the names of the saved profiles """
+    prefix = len(profile_key(""))
+    return sorted(key.decode()[prefix:]
+                  for key in cache_client.scan_iter(profile_key("*")))
+
+
+def profile_text(data: bytes, limit: int = 50) -> str:
+    """ Get the *`limit`* functions of a `pstats` file taking
+    the most cumulative time as text """
+    stream = StringIO()
+    with NamedTemporaryFile(suffix=".pstats") as file:
+        file.write(data)
+        file.flush()
+        pstats.Stats(file.name, stream=stream).sort_stats(
+            "cumulative").print_stats(limit)
+    return stream.getvalue()
@@ -0,0 +1,211 @@
+from os import getenv
+from threading import Lock
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+import numpy as np
+from rdkit.Chem import MolFromSmiles
+from src.chemistry import morgan_fingerprint, MORGAN_SIZE
+from src.dao import ChangesPruned, MoleculeDAO
+from src.library import SCAN_BATCH_SIZE
+from src.logger import logger
+
+# molecules compared at once, their words stay in the CPU cache
+CHUNK_SIZE = 32768
+# molecules written since loading merged into the matrix at once,
+# or a part of the stored molecules if it is more
+MERGE_SIZE = int(getenv("SIMILARITY_MERGE_SIZE", "4096"))
+
+# id, SMILES string and Tanimoto similarity of a found molecule
+Hit = Tuple[int, str, float]
+
+
+class Fingerprints(NamedTuple):
+    """
+    Morgan fingerprints of molecules as a matrix of `uint64` words
+    with a column for every molecule, so each word of a query
+    is compared with one contiguous row.
+    """
+    ids: np.ndarray
+    smiles: List[str]
+    columns: np.ndarray
+    counts: np.ndarray
+
+    @classmethod
+    def pack(cls, ids: Sequence[int], smiles: List[str],
+             fingerprints: Sequence[bytes]) -> "Fingerprints":
+        """ Pack the fingerprints of molecules ordered by *`ids`* """
+        rows = np.frombuffer(b"".join(fingerprints), dtype=np.uint64)
+        rows = rows.reshape(len(ids), MORGAN_SIZE // 64)
+        return cls(np.array(ids, dtype=np.int64), smiles,
+                   np.ascontiguousarray(rows.T),
+                   np.bitwise_count(rows).sum(axis=1, dtype=np.uint16))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def tanimoto(self, query: np.ndarray) -> np.ndarray:
+        """ Get the Tanimoto similarity of every molecule to the words
+        of a *`query`* fingerprint """
+        common = np.zeros(len(self), dtype=np.uint16)
+        words = np.empty(CHUNK_SIZE, dtype=np.uint64)
+        bits = np.empty(CHUNK_SIZE, dtype=np.uint8)
+        for start in range(0, len(self), CHUNK_SIZE):
+            end = min(start + CHUNK_SIZE, len(self))
+            size, total = end - start, common[start:end]
+            for row, word in zip(self.columns, query):
+                np.bitwise_and(row[start:end], word, out=words[:size])
+                np.bitwise_count(words[:size], out=bits[:size])
+                np.add(total, bits[:size], out=total)
+        union = self.counts + int(np.bitwise_count(query).sum()) - common
+        return common / np.maximum(union, 1, dtype=np.float32)
+
+    def top(self, similarity: np.ndarray, k: int,
+            threshold: float) -> List[Hit]:
+        """ Get the *`k`* most similar molecules, all of them
+        if *`k`* is not positive, with at least *`threshold`* """
+        found = np.flatnonzero(similarity >= threshold)
+        if 0 < k < len(found):
+            best = np.argpartition(similarity[found], -k)[-k:]
+            found = found[best]
+        return [(int(self.ids[index]), self.smiles[index],
+                 float(similarity[index])) for index in found]
+
+
+class State(NamedTuple):
+    """ The fingerprints searched by `SimilarityIndex` """
+    loaded: Fingerprints
+    # the loaded molecules not written since loading
+    current: np.ndarray
+    # the molecules written since loading
+    recent: Fingerprints
+
+
+def empty_state() -> State:
+    empty = Fingerprints.pack([], [], [])
+    return State(empty, np.ones(0, dtype=bool), empty)
+
+
+def merge(loaded: Fingerprints, current: np.ndarray,
+          recent: Fingerprints) -> State:
+    """ Merge the *`current`* *`loaded`* molecules and the *`recent`*
+    ones into one matrix ordered by ids """
+    kept = np.flatnonzero(current)
+    ids = np.concatenate([loaded.ids[kept], recent.ids])
+    smiles = [loaded.smiles[index] for index in kept] + recent.smiles
+    columns = np.concatenate([loaded.columns[:, kept], recent.columns],
+                             axis=1)
+    counts = np.concatenate([loaded.counts[kept], recent.counts])
+    order = np.argsort(ids, kind="stable")
+    merged = Fingerprints(ids[order], [smiles[index] for index in order],
+                          np.ascontiguousarray(columns[:, order]),
+                          counts[order])
+    return State(merged, np.ones(len(ids), dtype=bool),
+                 Fingerprints.pack([], [], []))
+
+
+class SimilarityIndex:
+    """
+    Morgan fingerprints of all stored molecules kept in memory,
+    every search compares a query with all of them at once.
+
+    Like `MoleculeLibrary` it is loaded once and refreshed with
+    the molecules written since. They are compared separately
+    from the loaded matrix until there are `MERGE_SIZE` of them.
+    """
+
+    def __init__(self) -> None:
+        self.state = empty_state()
+        self.written: Dict[int, Tuple[str, bytes]] = {}
+        self.version: int | None = None
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        _, current, recent = self.state
+        return int(current.sum()) + len(recent)
+
+    def load(self) -> None:
+        """ Load the fingerprints of all stored molecules """
+        with self.lock:
+            version = MoleculeDAO.version()
+            rows = [row for batch in MoleculeDAO.scan(
+                        SCAN_BATCH_SIZE, columns=('smiles', 'morgan'))
+                    for row in batch if row[2] is not None]
+            state = empty_state()
+            if rows:
+                ids, smiles, morgans = zip(*rows)
+                state = state._replace(
+                    loaded=Fingerprints.pack(ids, list(smiles), morgans),
+                    current=np.ones(len(rows), dtype=bool))
+            self.state, self.written = state, {}
+            self.version = version
+        logger.debug(f"Loaded similarity index of {len(self)} molecules, "
+                     f"version {version}")
+
+    def refresh(self) -> None:
+        """ Apply the molecules added, changed or deleted since the last
+        known change, or load the index the first time """
+        if self.version is None:
+            return self.load()
+        try:
+            with self.lock:
+                version, ids = MoleculeDAO.changes(self.version)
+                if not ids:
+                    self.version = version
+                    return
+                loaded, current, _ = self.state
+                current = current.copy()
+                positions = np.searchsorted(loaded.ids, ids)
+                for id, position in zip(ids, positions):
+                    if position < len(current) and loaded.ids[position] == id:
+                        current[position] = False
+                written = dict(self.written)
+                for id in ids:
+                    written.pop(id, None)
+                for start in range(0, len(ids), SCAN_BATCH_SIZE):
+                    for id, smiles, morgan in MoleculeDAO.library(
+                            ids[start:start + SCAN_BATCH_SIZE],
+                            columns=('smiles', 'morgan')):
+                        if morgan is not None:
+                            written[id] = smiles, morgan
+                rows = sorted(written.items())
+                recent = Fingerprints.pack([id for id, _ in rows],
+                                           [smiles for _, (smiles, _) in rows],
+                                           [morgan for _, (_, morgan) in rows])
+                if len(written) > max(MERGE_SIZE, len(current) // 16):
+                    self.state = merge(loaded, current, recent)
+                    self.written = {}
+                else:
+                    self.state = State(loaded, current, recent)
+                    self.written = written
+                self.version = version
+        except ChangesPruned:
+            # the index is older than the logged changes
+            return self.load()
+        logger.debug(f"Refreshed {len(ids)} similarity index molecules, "
+                     f"version {version}")
+
+    def search(self, mol: str, k: int = 10,
+               threshold: float = 0.0) -> List[Hit]:
+        """
+        Find the *`k`* stored molecules most similar to *`mol`*
+        as SMILES string, all of them if *`k`* is not positive,
+        with Tanimoto similarity of at least *`threshold`*.
+
+        Returns tuples of id, SMILES string and similarity,
+        the most similar first.
+        """
+        query = MolFromSmiles(mol)
+        if query is None:
+            return []
+        words = np.frombuffer(morgan_fingerprint(query), dtype=np.uint64)
+        # the state of the index when the search starts
+        loaded, current, recent = self.state
+        similarity = loaded.tanimoto(words)
+        similarity[~current] = -1
+        hits = (loaded.top(similarity, k, threshold)
+                + recent.top(recent.tanimoto(words), k, threshold))
+        hits.sort(key=lambda hit: (-hit[2], hit[0]))
+        return hits[:k] if k > 0 else hits
+
+
+# the similarity index of this process, loaded by the first search
+similarity_index = SimilarityIndex()
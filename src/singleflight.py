@@ -0,0 +1,37 @@
+from concurrent.futures import Future
+from threading import Lock
+from typing import Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Calls shared by the threads of a process: a call with the same key
+    as a call in flight is not made again, it waits for its result.
+    """
+
+    def __init__(self) -> None:
+        self.calls: Dict[str, Future] = {}
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    def run(self, key: str, function: Callable[..., T], *args) -> T:
+        """ Call *`function`* with *`args`* once for the callers
+        with the same *`key`* at the same time """
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = self.calls[key] = Future()
+        if leader:
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.calls[key]
+        return future.result()
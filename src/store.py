@@ -0,0 +1,226 @@
+import json
+from contextlib import contextmanager
+from fcntl import LOCK_EX, flock
+from os import fsync, getenv, listdir, makedirs, replace
+from os.path import getsize, join
+from shutil import rmtree
+from typing import Generator, Iterable, List, NamedTuple, Sequence, Tuple
+from uuid import uuid4
+import numpy as np
+from rdkit.Chem import Mol, MolFromSmiles
+from src.chemistry import FINGERPRINT_SIZE, pattern_fingerprint
+from src.dao import ChangesPruned, MoleculeDAO
+from src.logger import logger
+
+# directory of the memory-mapped library shared by the search processes
+LIBRARY_STORE = getenv("LIBRARY_STORE", "library_store")
+# segments of written molecules appended before the store is rebuilt
+STORE_SEGMENTS = int(getenv("STORE_SEGMENTS", "8"))
+
+MANIFEST = "manifest.json"
+# uint64 words of a pattern fingerprint
+WORDS = FINGERPRINT_SIZE // 64
+
+# id, SMILES string, pattern fingerprint and binary molecule
+Row = Tuple[int, str, bytes | None, bytes | None]
+
+
+def map_array(path: str, dtype: type) -> np.ndarray:
+    """ Map a file of *`dtype`* values read-only, an empty one can't be """
+    if getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class Segment(NamedTuple):
+    """
+    Molecules written at once into the store, ordered by id.
+
+    A segment is never changed, the molecules written later are
+    appended as new segments with their ids as `deleted`, so they
+    hide the earlier segments' molecules with the same ids.
+    """
+    ids: np.ndarray
+    # pattern fingerprints, a row of words for every molecule
+    fingerprints: np.ndarray
+    # the molecule i is `mols[mol_offsets[i]:mol_offsets[i + 1]]`
+    mols: np.ndarray
+    mol_offsets: np.ndarray
+    smiles: np.ndarray
+    smiles_offsets: np.ndarray
+    deleted: np.ndarray
+
+    @classmethod
+    def open(cls, path: str) -> "Segment":
+        """ Map the files of the segment at *`path`* """
+        return cls(map_array(join(path, "ids"), np.int64),
+                   map_array(join(path, "fingerprints"),
+                             np.uint64).reshape(-1, WORDS),
+                   map_array(join(path, "mols"), np.uint8),
+                   map_array(join(path, "mol_offsets"), np.int64),
+                   map_array(join(path, "smiles"), np.uint8),
+                   map_array(join(path, "smiles_offsets"), np.int64),
+                   map_array(join(path, "deleted"), np.int64))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def mol(self, index: int) -> bytes:
+        """ Get the binary molecule at *`index`* """
+        return bytes(self.mols[self.mol_offsets[index]:
+                               self.mol_offsets[index + 1]])
+
+    def smiles_at(self, index: int) -> str:
+        """ Get the SMILES string at *`index`* """
+        return bytes(self.smiles[self.smiles_offsets[index]:
+                                 self.smiles_offsets[index + 1]]).decode()
+
+    def positions(self, ids: Sequence[int]) -> np.ndarray:
+        """ Get the indexes of the molecules with *`ids`* found here """
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(self.ids, ids)
+        found = positions < len(self)
+        found[found] = self.ids[positions[found]] == ids[found]
+        return positions[found]
+
+
+def write_segment(path: str, rows: Iterable[Row],
+                  deleted: Sequence[int] = ()) -> int:
+    """
+    Write the molecule *`rows`* ordered by id as a segment at *`path`*
+    hiding the earlier molecules with *`deleted`* ids, the invalid
+    molecules are not written. Returns the number of written molecules.
+    """
+    makedirs(path)
+    names = ("ids", "fingerprints", "mols", "mol_offsets", "smiles",
+             "smiles_offsets")
+    files = {name: open(join(path, name), "wb") for name in names}
+    count = mol_offset = smiles_offset = 0
+    try:
+        files["mol_offsets"].write(np.int64(0).tobytes())
+        files["smiles_offsets"].write(np.int64(0).tobytes())
+        for id, smiles, fingerprint, binary in rows:
+            if binary is None:
+                mol = MolFromSmiles(smiles)
+                if mol is None:
+                    continue
+                binary = mol.ToBinary()
+                fingerprint = pattern_fingerprint(mol)
+            elif fingerprint is None:
+                fingerprint = pattern_fingerprint(Mol(binary))
+            encoded = smiles.encode()
+            mol_offset += len(binary)
+            smiles_offset += len(encoded)
+            files["ids"].write(np.int64(id).tobytes())
+            files["fingerprints"].write(fingerprint)
+            files["mols"].write(binary)
+            files["mol_offsets"].write(np.int64(mol_offset).tobytes())
+            files["smiles"].write(encoded)
+            files["smiles_offsets"].write(np.int64(smiles_offset).tobytes())
+            count += 1
+        with open(join(path, "deleted"), "wb") as file:
+            file.write(np.asarray(deleted, dtype=np.int64).tobytes())
+            fsync(file.fileno())
+    finally:
+        for file in files.values():
+            file.flush()
+            fsync(file.fileno())
+            file.close()
+    return count
+
+
+def read_manifest(store: str = LIBRARY_STORE) -> dict | None:
+    """ Get the version and the segments of the store, `None` if
+    it is not written yet """
+    try:
+        with open(join(store, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(store: str, version: int, segments: List[str]) -> None:
+    """ Replace the manifest at once, the searches opening the store
+    see either the old segments or the new ones """
+    temporary = join(store, f"{MANIFEST}.{uuid4().hex}")
+    with open(temporary, "w") as file:
+        json.dump({"version": version, "segments": segments}, file)
+        file.flush()
+        fsync(file.fileno())
+    replace(temporary, join(store, MANIFEST))
+
+
+def open_segments(store: str = LIBRARY_STORE
+                  ) -> Tuple[dict, List[Segment]] | None:
+    """
+    Map the segments of the store with its manifest having the version
+    of the last change they have, or get `None` if it is not written yet.
+
+    The segments removed by a rebuild after reading the manifest
+    are mapped from the new manifest.
+    """
+    while (manifest := read_manifest(store)) is not None:
+        try:
+            return manifest, [Segment.open(join(store, name))
+                              for name in manifest["segments"]]
+        except FileNotFoundError:
+            continue
+    return None
+
+
+@contextmanager
+def store_lock(store: str = LIBRARY_STORE) -> Generator[None, None, None]:
+    """ Let one process at a time write the store """
+    makedirs(store, exist_ok=True)
+    with open(join(store, "lock"), "w") as file:
+        flock(file, LOCK_EX)
+        yield
+
+
+def rebuild_store(store: str = LIBRARY_STORE,
+                  batch_size: int = 1000) -> int:
+    """ Write all stored molecules as the only segment of the store,
+    call it holding `store_lock`. Returns the new version """
+    # changes made while writing are appended again by `update_store`
+    version = MoleculeDAO.version()
+    name = f"segment-{uuid4().hex}"
+    count = write_segment(join(store, name),
+                          (row for batch in MoleculeDAO.scan(batch_size)
+                           for row in batch))
+    write_manifest(store, version, [name])
+    # the processes still mapping the old segments keep their files
+    for entry in listdir(store):
+        if entry.startswith("segment-") and entry != name:
+            rmtree(join(store, entry), ignore_errors=True)
+    logger.debug(f"Rebuilt library store of {count} molecules, "
+                 f"version {version}")
+    return version
+
+
+def update_store(store: str = LIBRARY_STORE,
+                 batch_size: int = 1000) -> int:
+    """
+    Append the molecules written since the last change of the store
+    as a new segment, or rebuild it when it has `STORE_SEGMENTS`
+    segments, is not written yet or older than the logged changes.
+    Returns the version of the store.
+    """
+    with store_lock(store):
+        manifest = read_manifest(store)
+        if (manifest is None
+                or len(manifest["segments"]) >= STORE_SEGMENTS):
+            return rebuild_store(store, batch_size)
+        try:
+            version, ids = MoleculeDAO.changes(manifest["version"])
+        except ChangesPruned:
+            return rebuild_store(store, batch_size)
+        if not ids:
+            return manifest["version"]
+        name = f"segment-{uuid4().hex}"
+        rows = (row for start in range(0, len(ids), batch_size)
+                for row in MoleculeDAO.library(ids[start:start + batch_size]))
+        count = write_segment(join(store, name), rows, deleted=ids)
+        write_manifest(store, version, manifest["segments"] + [name])
+    logger.debug(f"Appended {count} molecules to the library store, "
+                 f"version {version}")
+    return version
@@ -1,45 +1,335 @@
+from collections import defaultdict
+from os import getenv
+from time import time
 from src.celery_worker import celery
-from src.caching import redis_client, get_cached_result, set_cache
-from src.dao import MoleculeDAO
+from celery import chord, group
+from celery.signals import task_revoked, worker_init, worker_process_init
+from src.dao import ChangesPruned, MoleculeDAO
 from src.logger import logger
-from typing import List, Generator
-from rdkit.Chem import MolFromSmiles  # , Draw
+from src.caching import (get_cached_result, get_cached_queries,
+                         redis_client, search_key, search_task_key,
+                         finish_search_task,
+                         cache_ids, store_hits, forget_cached_query)
+from src.library import (SCAN_BATCH_SIZE, SearchStopped, library,
+                         match_entries, read_entries, task_checkpoint)
+from src.parallel import SEARCH_WORKERS, sharded_search
+from src.similarity import similarity_index
+from src.store import LIBRARY_STORE, update_store
+from src.chemistry import parse_query, pattern_fingerprint, screen
+from src.profiling import profiled, task_profile
+from typing import List, Generator, Sequence
+from rdkit.Chem import Mol, MolFromSmiles  # , Draw
+
+# molecule ids searched by one subtask of the distributed search
+SEARCH_CHUNK_SIZE = int(getenv("SEARCH_CHUNK_SIZE", "10000"))
+# seconds a search task runs at most before returning the hits found
+# so far as an incomplete result, no limit if not positive
+SEARCH_TIME_BUDGET = float(getenv("SEARCH_TIME_BUDGET", "300"))
+# last changes of stored molecules kept in their log, the libraries
+# further behind are loaded again instead of refreshed
+CHANGE_LOG_SIZE = int(getenv("CHANGE_LOG_SIZE", "100000"))
 
 
 def substructure_search(
         mols: List[str],
-        mol: str
+        mol: str,
+        fingerprints: Sequence[bytes | None] | None = None,
+        screening: bool = True,
+        binaries: Sequence[bytes | None] | None = None
         ) -> Generator[str, None, None]:
     """
     Find and return a list of all molecules as SMILES strings from *`mols`*
     that contain substructure *`mol`* as SMILES string.
+
+    With the pattern *`fingerprints`* of *`mols`* given, molecules missing
+    any bit of the query fingerprint are skipped without matching.
+    Set *`screening`* to False to match every molecule.
+
+    Molecules with *`binaries`* given are loaded from `Mol.ToBinary()`
+    pickles instead of parsing their SMILES strings.
     """
     if not (isinstance(mols, (list, tuple)) and
             all(map(lambda x: isinstance(x, str), mols))):
         raise TypeError('an input value does not match the expected data type')
     mol = MolFromSmiles(mol)
     if mol is not None:
-        for smiles in mols:
-            if ((compound := MolFromSmiles(smiles)) and
-                    compound.HasSubstructMatch(mol)):
+        if screening and fingerprints is not None:
+            query = int.from_bytes(pattern_fingerprint(mol), 'big')
+        else:
+            fingerprints, query = [None] * len(mols), 0
+        if binaries is None:
+            binaries = [None] * len(mols)
+        for smiles, fingerprint, binary in zip(mols, fingerprints, binaries):
+            if not screen(fingerprint, query):
+                continue
+            compound = Mol(binary) if binary else MolFromSmiles(smiles)
+            if compound and compound.HasSubstructMatch(mol):
                 yield smiles
 
 
-@celery.task
-def substructure_search_task(smiles):
-    # Get all stored chemical compounds
-    molecules = get_cached_result("SMILES")
-    if molecules:
-        source = "cache"
-        logger.debug(f"get_cached SMILES {len(molecules)}")
+@worker_init.connect
+def limit_concurrency(sender=None, **kwargs):
+    """ A worker searching in `SEARCH_WORKERS` processes runs only one
+    pool process, so the worker starts them once """
+    if SEARCH_WORKERS > 1 and sender is not None and sender.concurrency != 1:
+        logger.warning(f"Concurrency {sender.concurrency} is set to 1, "
+                       f"searches run in {SEARCH_WORKERS} processes")
+        sender.concurrency = 1
+
+
+@worker_process_init.connect
+def load_library(**kwargs):
+    """ Load the molecule library once in every worker process """
+    if SEARCH_WORKERS > 1:
+        sharded_search.start()
     else:
-        source = "database"
-        molecules = MoleculeDAO.smiles()
-        set_cache("SMILES", molecules, 5*60)
-        logger.debug(f"set_cache SMILES {len(molecules)}")
-    cache_key = f"search:{smiles}"
-    chemical_compounds = list(substructure_search(molecules, smiles))
-    search_result = {"query": smiles, "result": chemical_compounds}
-    set_cache(cache_key, search_result)
-    # sets an expiration of 60s
-    return {"source": source, "data": search_result}
+        library.load()
+
+
+def task_hits(task_id, query, ids):
+    """ The result of a search task finding molecules with `ids`,
+    stored in Redis for `/tasks/{task_id}` to read it in pages """
+    return {"query": query, "count": len(ids),
+            "hits": store_hits(task_id, ids)}
+
+
+@celery.task(bind=True)
+def substructure_search_task(self, smiles, screening=True, version=None,
+                             time_budget=SEARCH_TIME_BUDGET, profile=None):
+    """
+    Search substructure `smiles` and cache the hits at `version`,
+    the current one by default.
+
+    The task reports the molecules checked and the hits found so far
+    as its progress, except in `SEARCH_WORKERS` search processes.
+    When it is cancelled or runs longer than `time_budget` seconds
+    it stops with the hits found so far, returned as an incomplete
+    result that is not cached.
+
+    Started by a request profiled as `profile` the task is profiled
+    too, as its `task_profile`.
+    """
+    if profile is not None:
+        with profiled(task_profile(profile)):
+            return search_task(self, smiles, screening, version,
+                               time_budget)
+    return search_task(self, smiles, screening, version, time_budget)
+
+
+def search_task(task, smiles, screening, version, time_budget):
+    """ Run `substructure_search_task` """
+    source = "database"
+    if version is None:
+        version = MoleculeDAO.version()
+    hits, stopped = [], None
+    deadline = time() + time_budget if time_budget > 0 else None
+    try:
+        if SEARCH_WORKERS > 1:
+            # every search process stops on its own, the progress
+            # is not reported
+            hits, stopped = sharded_search.task_matches(
+                smiles, screening, task.request.id, deadline)
+        else:
+            # Bring the stored chemical compounds of this worker up to date
+            library.refresh()
+            total = len(library)
+            stop = task_checkpoint(task.request.id, deadline)
+
+            def checkpoint(checked):
+                if task.request.id is not None:
+                    task.update_state(state="PROGRESS", meta={
+                        "checked": checked, "total": total,
+                        "hits": len(hits)})
+                stop(checked)
+
+            try:
+                for hit in library.matches(smiles, screening,
+                                           checkpoint=checkpoint):
+                    hits.append(hit)
+            except SearchStopped as e:
+                stopped = str(e)
+        if stopped is not None:
+            logger.info(f"Search task {task.request.id} for {smiles} "
+                        f"stopped, {stopped}, after {len(hits)} hits")
+        ids = [id for id, _ in hits]
+        if stopped is None:
+            cache_ids(smiles, version, ids)
+    finally:
+        # the next requests find the cached result
+        finish_search_task(search_task_key(smiles, version, time_budget))
+    data = task_hits(task.request.id, smiles, ids)
+    data["complete"] = stopped is None
+    if stopped is not None:
+        data["stopped"] = stopped
+    return {"source": source, "data": data}
+
+
+@task_revoked.connect
+def forget_revoked_search(sender=None, request=None, **kwargs):
+    """ A revoked search task is not in flight any more, the same
+    searches start a new one """
+    if sender is not None and sender.name == substructure_search_task.name:
+        version = request.kwargs.get("version")
+        if version is not None:
+            finish_search_task(search_task_key(
+                request.args[0], version,
+                request.kwargs.get("time_budget", SEARCH_TIME_BUDGET)))
+
+
+@celery.task
+def search_chunk_task(smiles, first_id, last_id, screening=True):
+    """ Find the ids of the molecules with ids from `first_id`
+    to `last_id` """
+    library.refresh()
+    ids = range(first_id, last_id + 1)
+    return [id for id, _ in library.matches(smiles, screening, ids=ids)]
+
+
+@celery.task(bind=True)
+def merge_search_task(self, chunks, smiles, version):
+    """
+    Merge the molecule ids found by search chunks in order
+    and cache them at `version`
+    """
+    return finish_search(self.request.id, smiles, version,
+                         [id for chunk in chunks for id in chunk])
+
+
+def finish_search(task_id, smiles, version, ids):
+    """ Cache the molecule `ids` found by a distributed search
+    and store them as the result of the task `task_id` """
+    cache_ids(smiles, version, ids)
+    finish_search_task(search_key(smiles, version))
+    return {"source": "database", "data": task_hits(task_id, smiles, ids)}
+
+
+@celery.task(bind=True)
+def distributed_search_task(self, smiles, screening=True,
+                            chunk_size=SEARCH_CHUNK_SIZE, version=None):
+    """
+    Split the molecule id range into chunks of `chunk_size` ids searched
+    by workers in parallel, this task is replaced by the chord
+    of the chunks merging their hits as its result.
+
+    The result is cached at `version`, the current one by default.
+    """
+    if version is None:
+        version = MoleculeDAO.version()
+    id_range = MoleculeDAO.id_range()
+    if id_range is None:
+        return finish_search(self.request.id, smiles, version, [])
+    first, last = id_range
+    chunks = [search_chunk_task.s(smiles, start,
+                                  min(start + chunk_size - 1, last),
+                                  screening)
+              for start in range(first, last + 1, chunk_size)]
+    chunk_ids = [chunk.freeze().id for chunk in chunks]
+    self.update_state(state="PROGRESS", meta={"chunks": chunk_ids})
+    return self.replace(chord(group(chunks),
+                              merge_search_task.s(smiles, version)))
+
+
+@celery.task(bind=True)
+def batch_search_task(self, queries, screening=True, version=None):
+    """
+    Search every substructure of `queries` in one pass over the library
+    and cache their results at `version`, the current one by default.
+    The queries with results cached at `version` are not searched.
+    """
+    if version is None:
+        version = MoleculeDAO.version()
+    results, missing = {}, []
+    for query in dict.fromkeys(queries):
+        # counted by the request starting the task
+        cached = get_cached_result(search_key(query, version),
+                                   counted=False)
+        if cached is None:
+            missing.append(query)
+        else:
+            results[query] = cached["ids"]
+    if missing:
+        if SEARCH_WORKERS > 1:
+            batch = sharded_search.batch_matches(missing, screening)
+        else:
+            library.refresh()
+            batch = library.batch_matches(missing, screening)
+        for query, hits in zip(missing, batch):
+            results[query] = [id for id, _ in hits]
+            cache_ids(query, version, results[query])
+    return {"source": "database",
+            "data": [task_hits(f"{self.request.id}:{index}", query,
+                               results[query])
+                     for index, query in enumerate(queries)]}
+
+
+@celery.task
+def similarity_search_task(smiles, k=10, threshold=0.0):
+    """ Find the `k` stored molecules most similar to `smiles`
+    with Tanimoto similarity of at least `threshold` """
+    similarity_index.refresh()
+    hits = similarity_index.search(smiles, k, threshold)
+    return {"source": "database",
+            "data": {"query": smiles,
+                     "result": [{"id": id, "smiles": found,
+                                 "similarity": similarity}
+                                for id, found, similarity in hits]}}
+
+
+@celery.task(ignore_result=True)
+def maintain_cache_task():
+    """
+    Bring the cached results of the registered search queries up to
+    the last change of stored molecules, matching only the molecules
+    written since each result was cached instead of searching again.
+    """
+    versions = defaultdict(list)
+    for query, version in get_cached_queries().items():
+        versions[version].append(query)
+    for version, queries in versions.items():
+        try:
+            last, ids = MoleculeDAO.changes(version)
+        except ChangesPruned:
+            # searched again on request
+            for query in queries:
+                forget_cached_query(query, version)
+            continue
+        if not ids:
+            continue
+        # the molecules written since the version, without deleted ones
+        written = list(read_entries(ids))
+        changed = set(ids)
+        for query in queries:
+            cache_key = search_key(query, version)
+            cached = get_cached_result(cache_key, counted=False)
+            mol = parse_query(query)
+            if cached is None or mol is None:
+                # expired, searched again on request
+                forget_cached_query(query, version)
+                continue
+            hits = [id for id in cached["ids"] if id not in changed]
+            hits.extend(id for id, _ in match_entries(written, mol))
+            hits.sort()
+            cache_ids(cached["query"], last, hits)
+            redis_client.delete(cache_key)
+        logger.debug(f"Updated {len(queries)} cached searches "
+                     f"with {len(ids)} molecules, version {last}")
+
+
+@celery.task(ignore_result=True)
+def prune_changes_task():
+    """
+    Delete the logged changes of stored molecules before the oldest
+    version of a registered cached search, keeping the last
+    `CHANGE_LOG_SIZE` changes.
+    """
+    version = min([MoleculeDAO.version() - CHANGE_LOG_SIZE,
+                   *get_cached_queries().values()])
+    if version > 0 and (count := MoleculeDAO.prune_changes(version)):
+        logger.debug(f"Pruned {count} changes before version {version}")
+
+
+@celery.task(ignore_result=True)
+def update_store_task():
+    """ Append the written molecules to the library store mapped
+    by the search processes, or rebuild it """
+    update_store(LIBRARY_STORE, SCAN_BATCH_SIZE)
@@ -0,0 +1,5 @@
+def pytest_configure(config):
+    """ Create the tables of the test database before the tests
+    import the app """
+    from src.dao import migrate
+    migrate()
@@ -0,0 +1,20 @@
+from benchmarks.suite import compare, metrics
+
+
+def test_compare_with_baseline():
+    baseline = {"sizes": {"1000": {
+        "import": {"molecules_per_s": 1000.0, "inserted": 990},
+        "endpoints": {"GET /smiles/": {"p50_ms": 10.0, "p99_ms": 20.0}}}}}
+    assert metrics(baseline["sizes"]) == {
+        "1000.import.molecules_per_s": 1000.0,
+        "1000.import.inserted": 990,
+        "1000.endpoints.GET /smiles/.p50_ms": 10.0,
+        "1000.endpoints.GET /smiles/.p99_ms": 20.0}
+    assert compare(baseline, baseline) == []
+    results = {"sizes": {"1000": {
+        "import": {"molecules_per_s": 700.0, "inserted": 10},
+        "endpoints": {"GET /smiles/": {"p50_ms": 5.0, "p99_ms": 30.0}}}}}
+    regressions = compare(results, baseline, tolerance=0.25)
+    assert [regression.split(":")[0] for regression in regressions] == [
+        "1000.import.molecules_per_s", "1000.endpoints.GET /smiles/.p99_ms"]
+    assert compare(results, baseline, tolerance=0.5) == []
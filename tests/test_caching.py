@@ -0,0 +1,64 @@
+import fakeredis
+from prometheus_client import REGISTRY
+from src import caching
+from src.caching import (JSONSerializer, MsgpackSerializer, dumps,
+                         get_cached_result, get_hits, loads, search_key,
+                         set_cache, store_hits)
+
+
+def test_cache_encoding(monkeypatch):
+    small = {"query": "c1ccccc1", "ids": [1, 2, 3]}
+    large = {"query": "C", "ids": list(range(100000))}
+    for serializer in (JSONSerializer, MsgpackSerializer):
+        monkeypatch.setattr(caching, "serializer", serializer)
+        assert dumps(small)[:1] == serializer.tag
+        assert loads(dumps(small)) == small
+        assert dumps(large)[:2] == b"z" + serializer.tag
+        assert loads(dumps(large)) == large
+    # the values cached before changing the serializer are still read
+    assert loads(JSONSerializer.tag + JSONSerializer.dumps(small)) == small
+    assert len(dumps(large)) < len(JSONSerializer.dumps(large)) / 2
+
+
+def test_search_key():
+    # equivalent SMILES strings of a query share its key
+    assert search_key("C1=CC=CC=C1", 3) == search_key("c1ccccc1", 3)
+    assert search_key("OCC", 3) == search_key("CCO", 3)
+    assert search_key("CCO", 3) != search_key("CCN", 3)
+    # every write moves the searches to new keys
+    assert search_key("CCO", 3) != search_key("CCO", 4)
+
+
+def test_stored_hits(monkeypatch):
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(caching, "redis_client", client)
+    # pushed in more than one part
+    ids = list(range(1, 25002))
+    hits_key = store_hits("task", ids, expiration=60)
+    assert hits_key == "hits:task"
+    assert 0 < client.ttl(hits_key) <= 60
+    assert get_hits(hits_key) == ids[:100]
+    assert get_hits(hits_key, 100, 50) == ids[100:150]
+    assert get_hits(hits_key, 24990, 100) == ids[24990:]
+    assert get_hits(hits_key, 30000) == []
+    assert get_hits(hits_key, 0, 0) == []
+    assert get_hits(hits_key, 0, -1) == []
+    # stored again, the earlier hits are replaced
+    store_hits("task", [7])
+    assert get_hits(hits_key) == [7]
+
+
+def test_cache_lookups(monkeypatch):
+    def lookups(result):
+        return REGISTRY.get_sample_value("search_cache_requests_total",
+                                         {"result": result}) or 0
+    monkeypatch.setattr(caching, "cache_client", fakeredis.FakeRedis())
+    set_cache("cached", {"ids": [1]})
+    hits, misses = lookups("hit"), lookups("miss")
+    assert get_cached_result("cached") == {"ids": [1]}
+    assert get_cached_result("missing") is None
+    assert (lookups("hit"), lookups("miss")) == (hits + 1, misses + 1)
+    # the lookups of the service are not counted
+    assert get_cached_result("cached", counted=False) == {"ids": [1]}
+    assert get_cached_result("missing", counted=False) is None
+    assert (lookups("hit"), lookups("miss")) == (hits + 1, misses + 1)
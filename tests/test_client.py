@@ -1,7 +1,21 @@
-from time import sleep
-from pytest import mark, fixture
+import fakeredis
+import fakeredis.aioredis
+from kombu.exceptions import OperationalError
+from pytest import mark, fixture, raises
 from starlette.testclient import TestClient
-from src.main import app, redis_client
+import asyncio
+import json
+from itertools import count
+from threading import Event
+from time import sleep
+from src import caching, library, main, tasks
+from src.library import checkpoints, event_checkpoint
+from src.main import app
+from src.caching import (get_search_task, search_key, search_task_key,
+                         start_search_task)
+from src.celery_worker import celery
+from src.dao import MoleculeDAO
+from src.parallel import ShardedSearch
 # (substructure_search, get_server, retrieve_all_molecules, 
 #                    add_molecule_smiles, retrieve_molecule_by_id, update_molecule, 
 #                    delete_molecule, search_molecules, upload_molecules)
@@ -10,8 +24,29 @@ from src.main import app, redis_client
 client = TestClient(app)
 
 
-@mark.skip(reason="no way of currently testing cache")
-def test_caching_search_molecules():
+@fixture
+def fake_redis(monkeypatch):
+    """ Replace the Redis clients of the app, the tasks and the result
+    backend with fakeredis sharing one server """
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server, decode_responses=True)
+    for module in (caching, main, tasks):
+        monkeypatch.setattr(module, "redis_client", client)
+    monkeypatch.setattr(caching, "async_redis_client",
+                        fakeredis.aioredis.FakeRedis(
+                            server=server, decode_responses=True))
+    monkeypatch.setattr(caching, "cache_client",
+                        fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(caching, "async_cache_client",
+                        fakeredis.aioredis.FakeRedis(server=server))
+    # the result backend of every thread
+    backend_client = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(type(celery.backend), "client",
+                        property(lambda backend: backend_client))
+    return client
+
+
+def test_caching_search_molecules(fake_redis, monkeypatch):
     def search_request(query: str, source: str):
         response = client.get(f"/search/{query}")
         assert response.status_code == 200
@@ -20,14 +55,27 @@ def test_caching_search_molecules():
         assert data["source"] == source
         return data["data"]
 
-    query = "c1ccccc1"
-    data = search_request(query, "database")
-    assert redis_client.exists(f"search:{query}")
-    sleep(60-0.1)
-    assert data == search_request(query, "cache")
-    sleep(0.2)
-    assert not redis_client.exists(f"search:{query}")
-    search_request(query, "database")
+    # the cached results are maintained by the writing request
+    monkeypatch.setattr(celery.conf, "task_always_eager", True)
+    added = ["c1ccccc1CCCCF", "c1ccccc1CCCCCl"]
+    client.post("/smiles/", params={"smiles": added[0]})
+    try:
+        query = "c1ccccc1"
+        data = search_request(query, "database")
+        assert fake_redis.exists(search_key(query, MoleculeDAO.version()))
+        # an equivalent query shares the cached result
+        cached = search_request("C1=CC=CC=C1", "cache")
+        assert data["result"] == cached["result"]
+        # a write moves it to a new key with the written molecule
+        version = MoleculeDAO.version()
+        client.post("/smiles/", params={"smiles": added[1]})
+        assert not fake_redis.exists(search_key(query, version))
+        updated = search_request(query, "cache")
+        assert updated["result"] == data["result"] + [added[1]]
+    finally:
+        for smiles in added:
+            if (molecule := MoleculeDAO.find(smiles)) is not None:
+                MoleculeDAO.delete(molecule.id)
 
 
 @mark.skip(reason="no way of currently testing this")
@@ -42,6 +90,32 @@ def test_get_server():
     assert response.status_code == 200
     assert "server_id" in response.json()
 
+
+def test_metrics():
+    client.get("/")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert ('http_request_duration_seconds_count{method="GET",route="/",'
+            'status="200"}') in response.text
+
+
+def test_profile_request(monkeypatch):
+    from fakeredis import FakeRedis
+    from src import profiling
+    monkeypatch.setattr(profiling, "PROFILE_TOKENS", ["secret"])
+    monkeypatch.setattr(profiling, "cache_client", FakeRedis())
+    assert "X-Profile-Id" not in client.get("/").headers
+    assert client.get("/profiles/").status_code == 403
+    response = client.get("/", params={"profile_token": "secret"})
+    assert response.status_code == 200
+    name = response.headers["X-Profile-Id"]
+    headers = {"X-Profile-Token": "secret"}
+    assert client.get("/profiles/", headers=headers).json() == [name]
+    response = client.get(f"/profiles/{name}", headers=headers,
+                          params={"text": True})
+    assert "function calls" in response.text
+    assert client.get("/profiles/missing", headers=headers).status_code == 404
+
   
 # def test_add_molecule_smiles():
 #     pass
@@ -53,7 +127,219 @@ def test_get_server():
 
 # def test_search_molecules():
 
-# def test_upload_molecules():
+def test_search_task_not_sent(fake_redis, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OperationalError("broker unavailable")
+
+    monkeypatch.setattr(main.substructure_search_task, "apply_async", fail)
+    with raises(OperationalError):
+        client.post("/search/c1ccccc1CCCCBr")
+    # the next search starts a new task instead of waiting for this one
+    cache_key = search_key("c1ccccc1CCCCBr", MoleculeDAO.version())
+    assert get_search_task(cache_key) is None
+
+
+def test_search_waits_for_task(fake_redis, monkeypatch):
+    client.post("/smiles/", params={"smiles": "c1ccccc1CCCCI"})
+    cache_key = search_key("CCCCI", MoleculeDAO.version())
+    start_search_task(cache_key, "running")
+    monkeypatch.setattr(main, "SEARCH_TASK_WAIT", 0.1)
+    # the task runs longer than the request waits for it
+    response = client.get("/search/CCCCI")
+    assert response.status_code == 202
+    assert response.json()["task_id"] == "running"
+    assert response.json()["link"].endswith("/tasks/running")
+
+
+def test_search_task_time_budget(fake_redis, monkeypatch):
+    client.post("/smiles/", params={"smiles": "c1ccccc1CCCCCCI"})
+    client.post("/smiles/", params={"smiles": "c1ccccc1CCCCCCCI"})
+    # the task runs in the request and its result is stored
+    monkeypatch.setattr(celery.conf, "task_always_eager", True)
+    monkeypatch.setattr(celery.conf, "task_store_eager_result", True)
+    monkeypatch.setattr(main.substructure_search_task,
+                        "store_eager_result", True)
+    monkeypatch.setattr(library, "PROGRESS_INTERVAL", 1)
+    response = client.post("/search/CCCCCCI", params={"time_budget": 1e-9})
+    task = client.get(response.json()["link"].split("localhost")[1]).json()
+    assert task["status"] == "Task completed"
+    data = task["result"]["data"]
+    assert data["complete"] is False
+    assert data["stopped"] == "time budget"
+    # the complete search is not budgeted
+    response = client.post("/search/CCCCCCI", params={"time_budget": 0})
+    task = client.get(f"/tasks/{response.json()['task_id']}").json()
+    assert task["result"]["data"]["complete"] is True
+    assert data["count"] < task["result"]["data"]["count"]
+
+
+def test_complete_search_not_budgeted(fake_redis, monkeypatch):
+    MoleculeDAO.insert("c1ccccc1CCCCCCCCCI")
+    added = MoleculeDAO.last()
+    try:
+        version = MoleculeDAO.version()
+        start_search_task(search_task_key("CCCCCCCCCI", version, 5),
+                          "budgeted")
+        response = client.post("/search/CCCCCCCCCI",
+                               params={"time_budget": 5})
+        assert response.json()["task_id"] == "budgeted"
+        # a search without a budget does not wait for its incomplete
+        # result
+        monkeypatch.setattr(celery.conf, "task_always_eager", True)
+        response = client.post("/search/CCCCCCCCCI",
+                               params={"time_budget": 0})
+        assert response.json()["task_id"] != "budgeted"
+        assert get_search_task(search_key("CCCCCCCCCI", version)) is None
+        assert get_search_task(
+            search_task_key("CCCCCCCCCI", version, 5)) == "budgeted"
+    finally:
+        MoleculeDAO.delete(added.id)
+
+
+def test_batch_search_queries():
+    response = client.post("/search/batch/", json=[])
+    assert response.status_code == 400
+    assert response.json()["detail"] == "At least one query is required."
+    response = client.post("/search/batch/", json=["CCO", "not-SMILES"])
+    assert response.status_code == 400
+    assert "['not-SMILES']" in response.json()["detail"]
+
+
+def test_stream_search(fake_redis, monkeypatch):
+    for smiles in ("c1ccccc1CCCCCCCCI", "CCCCCCCCI", "OCCCCCCCCI"):
+        client.post("/smiles/", params={"smiles": smiles})
+    expected = client.get("/search/CCCCCCCCI").json()["data"]["result"]
+    assert len(expected) >= 3
+    sharded = ShardedSearch(workers=2)
+    try:
+        for workers in (0, 2):
+            monkeypatch.setattr(main, "SEARCH_WORKERS", workers)
+            monkeypatch.setattr(main, "sharded_search", sharded)
+            # the cached result is searched again
+            params = {"stream": True, "offset": 1, "limit": 1,
+                      "no_cache": True}
+            response = client.get("/search/CCCCCCCCI", params=params)
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith(
+                "application/x-ndjson")
+            lines = response.text.splitlines()
+            assert [json.loads(line) for line in lines] == [
+                {"smiles": expected[1]}]
+            params["limit"] = 100
+            response = client.get("/search/CCCCCCCCI", params=params)
+            assert [json.loads(line)["smiles"]
+                    for line in response.text.splitlines()] == expected[1:]
+    finally:
+        sharded.close()
+
+
+def test_task_result_pages(fake_redis):
+    added = [f"c1ccccc1{'C' * n}Br" for n in range(10, 15)]
+    version = MoleculeDAO.version()
+    MoleculeDAO.insert(*added)
+    _, ids = MoleculeDAO.changes(version)
+    try:
+        celery.backend.store_result("paged", {
+            "source": "database",
+            "data": tasks.task_hits("paged", "CCCCCCCCCCBr", ids)},
+            "SUCCESS")
+
+        def page(**params):
+            response = client.get("/tasks/paged", params=params)
+            assert response.status_code == 200
+            return response.json()["result"]["data"]
+
+        data = page(offset=1, limit=2)
+        assert data["count"] == 5
+        assert (data["offset"], data["limit"]) == (1, 2)
+        assert data["result"] == added[1:3]
+        assert "hits" not in data
+        assert page(offset=3, limit=2)["result"] == added[3:]
+        assert page()["result"] == added
+        assert page(offset=5)["result"] == []
+        assert page(limit=0)["result"] == []
+        assert page(limit=-1)["result"] == []
+    finally:
+        for id in ids:
+            MoleculeDAO.delete(id)
+
+
+@mark.parametrize("cancelled", [False, True])
+def test_stream_stops_on_disconnect(monkeypatch, cancelled):
+    monkeypatch.setattr(main, "DISCONNECT_POLL", 0.01)
+    stopped, closed, scanned = Event(), Event(), []
+
+    def scan():
+        # a hit, then a long scan without hits
+        try:
+            yield 1, "CCO"
+            for position in checkpoints(count(), event_checkpoint(stopped),
+                                        1):
+                scanned.append(position)
+                sleep(0.001)
+        finally:
+            closed.set()
+
+    class Client:
+        """ The request of a client leaving during the scan,
+        or staying until the response is cancelled """
+        async def is_disconnected(self):
+            return not cancelled and len(scanned) > 10
+
+    async def stream():
+        lines = main.stream_hits(Client(), scan(), 10, stopped=stopped)
+        assert await anext(lines) == '{"smiles": "CCO"}\n'
+        if not cancelled:
+            return [line async for line in lines]
+        waiting = asyncio.ensure_future(anext(lines))
+        while len(scanned) <= 10:
+            await asyncio.sleep(0.01)
+        waiting.cancel()
+        with raises(asyncio.CancelledError):
+            await waiting
+
+    assert asyncio.run(stream()) == (None if cancelled else [])
+    # the scan stopped at its next checkpoint and the generator is closed
+    assert stopped.is_set() and closed.is_set()
+    position = len(scanned)
+    sleep(0.05)
+    assert len(scanned) == position
+
+
+def test_upload_molecules():
+    # molecules no other test adds, removed again below
+    upload = ("CCCCCCCCCO\r\nOCCCCCCCCC\nnot-SMILES\n\n c1ccccc1CCCCCN \n"
+              "C1CCCCC1CCCCCO")
+    try:
+        response = client.post(
+            "/molecules/",
+            files={"file": ("upload.txt", upload, "text/plain")})
+        assert response.status_code == 201
+        summary = response.json()
+        assert summary["inserted"] == 3
+        assert summary["duplicates"] == 1
+        assert summary["invalid"] == 1
+        response = client.post(
+            "/molecules/",
+            files={"file": ("upload.txt", upload, "text/plain")})
+        assert response.json() == {"inserted": 0, "duplicates": 4,
+                                   "invalid": 1}
+    finally:
+        for smiles in ("CCCCCCCCCO", "c1ccccc1CCCCCN", "C1CCCCC1CCCCCO"):
+            if (molecule := MoleculeDAO.find(smiles)) is not None:
+                MoleculeDAO.delete(molecule.id)
+
+
+def test_retrieve_molecule_by_smiles():
+    client.post("/smiles/", params={"smiles": "CC(=O)O"})
+    response = client.get("/smiles/exact/", params={"smiles": "OC(C)=O"})
+    assert response.status_code == 200
+    assert response.json()["smiles"] == "CC(=O)O"
+    response = client.post("/smiles/", params={"smiles": "OC(C)=O"})
+    assert response.status_code == 409
+    response = client.get("/smiles/exact/", params={"smiles": "C#CC#C"})
+    assert response.status_code == 404
+
 
 # Note that relative imports are based on the name of the current module. Since 
 # the name of the main module is always "__main__", modules intended for use as 
@@ -0,0 +1,291 @@
+from concurrent.futures import ThreadPoolExecutor
+from os import getpid
+from rdkit.Chem import MolFromSmiles
+from rdkit.DataStructs import TanimotoSimilarity
+from src.chemistry import (morgan_generator, parse_query, pattern_fingerprint,
+                           screen, smarts_query)
+from src import metrics
+from src.dao import ChangesPruned, MoleculeDAO
+from prometheus_client import REGISTRY
+from pytest import raises
+from src.library import (MappedLibrary, MoleculeLibrary, TableScan,
+                         checkpoints, match_entries, read_entries)
+from src.parallel import ShardedSearch
+from src.similarity import SimilarityIndex
+from src.store import read_manifest, update_store
+
+
+def test_library_refresh():
+    library = MoleculeLibrary()
+    library.load()
+    size = len(library)
+    MoleculeDAO.insert("c1ccccc1CCN")
+    added = MoleculeDAO.last()
+    library.refresh()
+    assert len(library) == size + 1
+    assert "c1ccccc1CCN" in library.search("CCN")
+    MoleculeDAO.update(added.id, "c1ccccc1CCS")
+    library.refresh()
+    assert "c1ccccc1CCS" in library.search("CCS")
+    assert "c1ccccc1CCN" not in library.search("CCN")
+    MoleculeDAO.delete(added.id)
+    library.refresh()
+    assert len(library) == size
+    assert "c1ccccc1CCS" not in library.search("CCS")
+
+
+def test_match_written_entries():
+    version = MoleculeDAO.version()
+    MoleculeDAO.insert("c1ccccc1CCCN", "CCCCCCCC")
+    _, ids = MoleculeDAO.changes(version)
+    try:
+        written = list(read_entries(ids))
+        assert [id for id, _ in written] == ids
+        hits = match_entries(written, parse_query("c1ccccc1"))
+        assert [smiles for _, smiles in hits] == ["c1ccccc1CCCN"]
+    finally:
+        for id in ids:
+            MoleculeDAO.delete(id)
+
+
+def test_search_metrics():
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    scanned = sample("search_molecules_scanned_total")
+    matching = sample("search_stage_duration_seconds_count", stage="matching")
+    MoleculeDAO.insert("c1ccccc1CCCCO")
+    library = MoleculeLibrary()
+    library.load()
+    hits = library.matches("c1ccccc1")
+    next(hits)
+    hits.close()
+    assert sample("search_stage_duration_seconds_count",
+                  stage="matching") == matching + 1
+    assert scanned < sample("search_molecules_scanned_total") <= (
+        scanned + len(library))
+
+
+def test_clear_metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "MULTIPROC_DIR", str(tmp_path))
+    for name in ("counter_1.db", f"counter_{getpid()}.db", "notes.txt"):
+        (tmp_path / name).write_bytes(b"")
+    metrics.clear_metrics()
+    # the files of this process are kept
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        f"counter_{getpid()}.db", "notes.txt"]
+
+
+def test_sharded_search():
+    MoleculeDAO.insert("CCO", "c1ccccc1", "Cc1ccccc1", "CC(=O)O")
+    library = MoleculeLibrary()
+    library.load()
+    sharded = ShardedSearch(workers=2)
+    try:
+        for mol in ["c1ccccc1", "O", "C"]:
+            expected = list(library.matches(mol))
+            assert sharded.matches(mol) == expected
+            assert sharded.matches(mol, max_num=2) == expected[:2]
+    finally:
+        sharded.close()
+
+
+def test_sharded_search_concurrency():
+    library = MoleculeLibrary()
+    library.load()
+    queries = ["c1ccccc1", "O", "C", "CC"] * 4
+    expected = [list(library.matches(mol)) for mol in queries]
+    sharded = ShardedSearch(workers=2)
+    try:
+        # searches from many threads are answered in any order
+        with ThreadPoolExecutor(4) as executor:
+            assert list(executor.map(sharded.matches, queries)) == expected
+        # a stopped search process is started again by the next search
+        sharded.shards[0].process.kill()
+        sharded.shards[0].process.join()
+        assert sharded.matches("O") == expected[1]
+        assert all(shard.is_alive() for shard in sharded.shards)
+    finally:
+        sharded.close()
+
+
+def test_table_scan():
+    MoleculeDAO.insert("CCO", "c1ccccc1", "Cc1ccccc1", "CC(=O)O")
+    library = MoleculeLibrary()
+    library.load()
+    table = TableScan(batch_size=2)
+    assert len(table) == len(library)
+    for mol in ["c1ccccc1", "O", "C"]:
+        assert list(table.matches(mol)) == list(library.matches(mol))
+        assert (list(table.matches(mol, screening=False)) ==
+                list(library.matches(mol)))
+
+
+def test_scan_fingerprint_screen():
+    MoleculeDAO.insert("CCO", "c1ccccc1", "Cc1ccccc1", "CC(=O)O")
+    query = pattern_fingerprint(MolFromSmiles("c1ccccc1"))
+    screened = [row for batch in MoleculeDAO.scan(fingerprint=query)
+                for row in batch]
+    found = {smiles for _, smiles, *_ in screened}
+    assert {"c1ccccc1", "Cc1ccccc1"} <= found
+    assert not {"CCO", "CC(=O)O"} & found
+    assert all(screen(fp, int.from_bytes(query, 'big'))
+               for _, _, fp, _ in screened)
+
+
+def test_batch_matches():
+    MoleculeDAO.insert("CCO", "c1ccccc1", "Cc1ccccc1", "CC(=O)O")
+    mols = ["c1ccccc1", "O", "C", "not-SMILES"]
+    library = MoleculeLibrary()
+    library.load()
+    expected = [list(library.matches(mol)) for mol in mols]
+    assert library.batch_matches(mols) == expected
+    assert library.batch_matches(mols, screening=False) == expected
+    assert TableScan(batch_size=2).batch_matches(mols) == expected
+    sharded = ShardedSearch(workers=2)
+    try:
+        assert sharded.batch_matches(mols) == expected
+    finally:
+        sharded.close()
+
+
+def test_smarts_search():
+    MoleculeDAO.insert("CCO", "c1ccccc1", "Cc1ccccc1", "CC(=O)O", "C1CCCCC1")
+    library = MoleculeLibrary()
+    library.load()
+    assert parse_query(smarts_query("[R]")) is parse_query(smarts_query("[R]"))
+    assert parse_query(smarts_query("[C")) is None
+    ring = list(library.search(smarts_query("[R]")))
+    assert {"c1ccccc1", "Cc1ccccc1", "C1CCCCC1"} <= set(ring)
+    assert not {"CCO", "CC(=O)O"} & set(ring)
+    # an atom list and a recursive SMARTS
+    acids = list(library.search(smarts_query("[$(C=O)][OX2H1]")))
+    assert "CC(=O)O" in acids and "CCO" not in acids
+    assert set(library.search(smarts_query("[C,c]O"))) >= {"CCO", "CC(=O)O"}
+    mols = [smarts_query("[R]"), "c1ccccc1", smarts_query("[$(C=O)]O")]
+    expected = [list(library.matches(mol)) for mol in mols]
+    assert library.batch_matches(mols) == expected
+    assert TableScan(batch_size=2).batch_matches(mols) == expected
+
+
+def test_search_checkpoints():
+    calls = []
+    assert list(checkpoints(range(5), calls.append, 2)) == list(range(5))
+    assert calls == [2, 4]
+
+    def stop(checked):
+        raise TimeoutError
+
+    # the search stops with the exception of its checkpoint
+    with raises(TimeoutError):
+        list(checkpoints(range(5), stop, 2))
+
+
+def test_mapped_library(tmp_path):
+    MoleculeDAO.insert("CCO", "c1ccccc1", "Cc1ccccc1", "CC(=O)O")
+    store = str(tmp_path)
+    mols = ["c1ccccc1", "O", "C", "not-SMILES"]
+    library = MoleculeLibrary()
+    library.load()
+    mapped = MappedLibrary(store=store)
+    mapped.load()
+    assert len(read_manifest(store)["segments"]) == 1
+    assert len(mapped) == len(library)
+    for mol in mols:
+        assert list(mapped.matches(mol)) == list(library.matches(mol))
+    MoleculeDAO.insert("c1ccccc1CCN")
+    added = MoleculeDAO.last()
+    MoleculeDAO.update(next(iter(library.entries)), "c1ccccc1O")
+    try:
+        # the written molecules are searched before the store has them
+        library.refresh()
+        mapped.refresh()
+        expected = [list(library.matches(mol)) for mol in mols]
+        assert [list(mapped.matches(mol)) for mol in mols] == expected
+        assert mapped.batch_matches(mols) == expected
+        update_store(store)
+        assert len(read_manifest(store)["segments"]) == 2
+        for written in (mapped, MappedLibrary(store=store)):
+            written.refresh()
+            assert len(written) == len(library)
+            assert [list(written.matches(mol)) for mol in mols] == expected
+            assert written.batch_matches(mols) == expected
+            assert written.batch_matches(mols, screening=False) == expected
+        assert mapped.entries == {}
+        shards = [MappedLibrary((index, 2), store) for index in range(2)]
+        for shard in shards:
+            shard.load()
+        assert sum(map(len, shards)) == len(library)
+    finally:
+        MoleculeDAO.delete(added.id)
+    mapped.refresh()
+    assert "c1ccccc1CCN" not in mapped.search("c1ccccc1")
+
+
+def test_refresh_pruned_changes(tmp_path):
+    store = str(tmp_path)
+    library, mapped, index = (MoleculeLibrary(), MappedLibrary(store=store),
+                              SimilarityIndex())
+    for loaded in (library, mapped, index):
+        loaded.load()
+    version = MoleculeDAO.version()
+    MoleculeDAO.insert("c1ccccc1CCCCCCCCCCN", "c1ccccc1CCCCCCCCCCCN")
+    _, ids = MoleculeDAO.changes(version)
+    try:
+        # only the last change is kept
+        assert MoleculeDAO.prune_changes(MoleculeDAO.version()) > 0
+        with raises(ChangesPruned):
+            MoleculeDAO.changes(version)
+        assert MoleculeDAO.changes(MoleculeDAO.version())[1] == []
+        # loaded again instead
+        for loaded in (library, mapped, index):
+            loaded.refresh()
+            assert loaded.version == MoleculeDAO.version()
+        assert read_manifest(store)["version"] == MoleculeDAO.version()
+        for loaded in (library, mapped):
+            assert [id for id, _ in loaded.matches("CCCCCCCCCCN")] == ids
+        assert [id for id, _, _ in index.search(
+            "c1ccccc1CCCCCCCCCCN", k=2)] == ids
+    finally:
+        for id in ids:
+            MoleculeDAO.delete(id)
+
+
+def morgan_similarity(smiles, other):
+    return TanimotoSimilarity(
+        morgan_generator.GetFingerprint(MolFromSmiles(smiles)),
+        morgan_generator.GetFingerprint(MolFromSmiles(other)))
+
+
+def test_similarity_search():
+    index = SimilarityIndex()
+    index.load()
+    MoleculeDAO.insert("c1ccccc1CCN")
+    added = MoleculeDAO.last()
+    try:
+        index.refresh()
+        hits = index.search("c1ccccc1CCN", k=0)
+        assert len(hits) == len(index) == MoleculeDAO.count()
+        assert hits[0] == (added.id, "c1ccccc1CCN", 1.0)
+        for _, smiles, similarity in hits:
+            assert abs(similarity - morgan_similarity(
+                "c1ccccc1CCN", smiles)) < 1e-6
+        similarities = [similarity for _, _, similarity in hits]
+        assert similarities == sorted(similarities, reverse=True)
+        assert index.search("c1ccccc1CCN", k=3) == hits[:3]
+        assert all(similarity >= 0.3 for _, _, similarity
+                   in index.search("c1ccccc1CCN", k=0, threshold=0.3))
+        MoleculeDAO.update(added.id, "c1ccccc1CCS")
+        index.refresh()
+        assert index.search("c1ccccc1CCS", k=1)[0][:2] == (added.id,
+                                                           "c1ccccc1CCS")
+        assert (added.id, "c1ccccc1CCN", 1.0) not in index.search(
+            "c1ccccc1CCN")
+    finally:
+        MoleculeDAO.delete(added.id)
+    index.refresh()
+    assert added.id not in [id for id, _, _ in index.search("CCS", k=0)]
+    # the molecules written since loading searched as loaded ones
+    reloaded = SimilarityIndex()
+    reloaded.load()
+    assert reloaded.search("CCS", k=0) == index.search("CCS", k=0)
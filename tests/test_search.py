@@ -1,5 +1,7 @@
 from pytest import mark, fixture, raises
+from rdkit.Chem import MolFromSmiles
 from src.main import substructure_search
+from src.chemistry import pattern_fingerprint
 
 
 @fixture
@@ -66,4 +68,34 @@ def test_function_raises_exceptions_no_args(molecules_storage):
     with raises(TypeError, match=r'missing \d required positional argument'):
         substructure_search()
     with raises(TypeError, match=r'missing \d required positional argument'):
-        substructure_search(molecules_storage)
\ No newline at end of file
+        substructure_search(molecules_storage)
+
+
+def fingerprints(mols):
+    return [pattern_fingerprint(m) if (m := MolFromSmiles(s)) else None
+            for s in mols]
+
+
+@mark.parametrize("mol", ["c1ccccc1", "C(=O)O", "O", "CC", "N", "c1ccncc1"])
+def test_screening_same_result(molecules_storage, mol):
+    mols = molecules_storage + ["Cc1ccccc1", "C(=O)O", "not-SMILES", "CCN"]
+    fps = fingerprints(mols)
+    expected = list(substructure_search(mols, mol, fps, screening=False))
+    assert list(substructure_search(mols, mol, fps)) == expected
+    assert list(substructure_search(mols, mol)) == expected
+
+
+def test_screening_skips_molecules(molecules_storage):
+    fps = fingerprints(molecules_storage)
+    # a fingerprint without any bits set screens out every molecule
+    empty = [bytes(len(fp)) for fp in fps]
+    assert list(substructure_search(molecules_storage, "C", empty)) == []
+    assert list(substructure_search(
+        molecules_storage, "C", empty, screening=False)) == molecules_storage
+
+
+def test_search_binary_molecules(molecules_storage):
+    binaries = [MolFromSmiles(s).ToBinary() for s in molecules_storage]
+    assert list(substructure_search(
+        molecules_storage, "c1ccccc1", binaries=binaries)) == [
+            "c1ccccc1", "CC(=O)Oc1ccccc1C(=O)O"]
@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+from time import sleep
+from pytest import raises
+from src.singleflight import SingleFlight
+
+
+def test_single_flight():
+    flight, started, release = SingleFlight(), Event(), Event()
+    calls = []
+
+    def search(query):
+        calls.append(query)
+        started.set()
+        release.wait(5)
+        return [query]
+
+    with ThreadPoolExecutor(4) as pool:
+        leader = pool.submit(flight.run, "CCO", search, "CCO")
+        started.wait(5)
+        waiting = [pool.submit(flight.run, "CCO", search, "CCO")
+                   for _ in range(3)]
+        # the waiting calls find the call in flight
+        sleep(0.2)
+        release.set()
+        results = [leader.result()] + [w.result() for w in waiting]
+    assert calls == ["CCO"]
+    assert results == [["CCO"]] * 4
+    assert len(flight) == 0
+    # the next call after the flight is made again
+    assert flight.run("CCO", search, "CCO") == ["CCO"]
+    assert calls == ["CCO", "CCO"]
+
+
+def test_single_flight_error():
+    def fail():
+        raise ValueError("search failed")
+
+    flight = SingleFlight()
+    with raises(ValueError):
+        flight.run("CCO", fail)
+    assert len(flight) == 0
@@ -0,0 +1,170 @@
+import fakeredis
+from pytest import fixture, raises
+from src import caching, library as library_module, tasks
+from src.caching import (CACHED_QUERIES, cache_ids, cancel_search_task,
+                         forget_cached_query, get_cached_queries,
+                         get_cached_result, get_hits, get_search_task,
+                         search_key, search_task_key, start_search_task)
+from src.celery_worker import celery
+from src.dao import ChangesPruned, MoleculeDAO
+from src.library import library
+from src.parallel import ShardedSearch
+from src.tasks import (SEARCH_TIME_BUDGET, distributed_search_task,
+                       maintain_cache_task, prune_changes_task,
+                       merge_search_task, search_chunk_task,
+                       substructure_search_task)
+
+
+@fixture
+def redis(monkeypatch):
+    """ Replace the Redis clients of the tasks and the result backend
+    with fakeredis sharing one server """
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server, decode_responses=True)
+    for module in (caching, tasks):
+        monkeypatch.setattr(module, "redis_client", client)
+    monkeypatch.setattr(celery.backend, "client",
+                        fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(caching, "cache_client",
+                        fakeredis.FakeRedis(server=server))
+    return client
+
+
+@fixture
+def molecules():
+    """ Ids of stored molecules with and without a benzene ring """
+    version = MoleculeDAO.version()
+    MoleculeDAO.insert("c1ccccc1CCCCCCS", "CCCCCCCS", "c1ccccc1CCCCCCCS",
+                       "CCCCCCCCS", "c1ccccc1CCCCCCCCS")
+    _, ids = MoleculeDAO.changes(version)
+    yield ids
+    for id in ids:
+        MoleculeDAO.delete(id)
+
+
+def benzene_hits(ids):
+    library.refresh()
+    return [id for id, _ in library.matches("c1ccccc1", ids=ids)]
+
+
+def test_search_chunk_task(redis, molecules):
+    first, last = molecules[1], molecules[3]
+    hits = search_chunk_task.apply(args=("c1ccccc1", first, last)).get()
+    assert hits == [molecules[2]]
+    # the ids of a chunk need not be stored
+    assert search_chunk_task.apply(
+        args=("c1ccccc1", last + 1000, last + 2000)).get() == []
+
+
+def test_merge_search_task(redis):
+    result = merge_search_task.apply(args=([[1, 3], [], [5]], "C", 7),
+                                     task_id="merge").get()
+    assert result["data"]["count"] == 3
+    assert get_hits(result["data"]["hits"]) == [1, 3, 5]
+    assert get_cached_result(search_key("C", 7))["ids"] == [1, 3, 5]
+
+
+def test_distributed_search_task(redis, molecules):
+    version = MoleculeDAO.version()
+    first, last = MoleculeDAO.id_range()
+    expected = benzene_hits(range(first, last + 1))
+    assert molecules[0] in expected and molecules[1] not in expected
+    # the task is replaced by the chord of its chunks merging their hits
+    result = distributed_search_task.apply(args=("c1ccccc1",),
+                                           kwargs={"chunk_size": 2}).get()
+    assert result["data"]["count"] == len(expected)
+    assert get_hits(result["data"]["hits"], 0, len(expected)) == expected
+    assert (get_cached_result(search_key("c1ccccc1", version))["ids"]
+            == expected)
+
+
+def stopped_search(task_id, **kwargs):
+    """ Run a search task checking after every molecule, it stops
+    before finding all hits """
+    version = MoleculeDAO.version()
+    task_key = search_task_key("c1ccccc1", version,
+                               kwargs.get("time_budget", SEARCH_TIME_BUDGET))
+    start_search_task(task_key, task_id)
+    result = substructure_search_task.apply(
+        args=("c1ccccc1",), kwargs={"version": version, **kwargs},
+        task_id=task_id).get()
+    assert result["data"]["complete"] is False
+    assert result["data"]["count"] < len(benzene_hits(None))
+    # an incomplete result is not cached, the next search starts again
+    assert get_cached_result(search_key("c1ccccc1", version)) is None
+    assert get_search_task(task_key) is None
+    return result["data"]["stopped"]
+
+
+def test_search_task_cancelled(redis, molecules, monkeypatch):
+    monkeypatch.setattr(library_module, "PROGRESS_INTERVAL", 1)
+    cancel_search_task("cancelled")
+    assert stopped_search("cancelled") == "cancelled"
+
+
+def test_search_task_time_budget(redis, molecules, monkeypatch):
+    monkeypatch.setattr(library_module, "PROGRESS_INTERVAL", 1)
+    assert stopped_search("late", time_budget=1e-9) == "time budget"
+
+
+def test_sharded_search_task_time_budget(redis, molecules, monkeypatch):
+    # the search processes are started with the environment
+    monkeypatch.setenv("SEARCH_PROGRESS_INTERVAL", "1")
+    sharded = ShardedSearch(workers=2)
+    monkeypatch.setattr(tasks, "SEARCH_WORKERS", 2)
+    monkeypatch.setattr(tasks, "sharded_search", sharded)
+    try:
+        assert stopped_search("late", time_budget=1e-9) == "time budget"
+    finally:
+        sharded.close()
+
+
+def test_maintain_cache_task(redis, molecules):
+    version = MoleculeDAO.version()
+    hits = benzene_hits(None)
+    assert hits
+    cache_ids("c1ccccc1", version, hits)
+    # registered without a cached result, it expired
+    redis.hset(CACHED_QUERIES, "CCCCCCCCCCS", version)
+    MoleculeDAO.insert("c1ccccc1CCCCCCCCCS")
+    added = MoleculeDAO.last()
+    try:
+        maintain_cache_task.apply().get()
+        last = MoleculeDAO.version()
+        assert get_cached_queries() == {"c1ccccc1": last}
+        cached = get_cached_result(search_key("c1ccccc1", last))
+        assert cached["ids"] == sorted(hits + [added.id])
+        assert get_cached_result(search_key("c1ccccc1", version)) is None
+    finally:
+        MoleculeDAO.delete(added.id)
+
+
+def test_forget_cached_query(redis):
+    redis.hset(CACHED_QUERIES, "CCS", 2)
+    # registered again at a newer version meanwhile
+    assert not forget_cached_query("CCS", 1)
+    assert get_cached_queries() == {"CCS": 2}
+    assert forget_cached_query("CCS", 2)
+    assert get_cached_queries() == {}
+
+
+def test_prune_changes_task(redis, molecules, monkeypatch):
+    monkeypatch.setattr(tasks, "CHANGE_LOG_SIZE", 0)
+    version = MoleculeDAO.version()
+    MoleculeDAO.insert("c1ccccc1CCCCCCCCCCS")
+    added = MoleculeDAO.last()
+    try:
+        # the changes since a cached search are kept
+        redis.hset(CACHED_QUERIES, "c1ccccc1", version)
+        prune_changes_task.apply().get()
+        assert MoleculeDAO.changes(version)[1] == [added.id]
+        redis.delete(CACHED_QUERIES)
+        prune_changes_task.apply().get()
+        with raises(ChangesPruned):
+            MoleculeDAO.changes(version)
+        # the cached result is not maintained any more
+        redis.hset(CACHED_QUERIES, "c1ccccc1", version)
+        maintain_cache_task.apply().get()
+        assert get_cached_queries() == {}
+    finally:
+        MoleculeDAO.delete(added.id)